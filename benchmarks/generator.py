@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Builds synthetic moodle data and .mdt work trees of configurable size.
+
+The data has the same shape as the web service responses, so it can be written to a work tree
+or served to MoodleSession.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+from pathlib import Path
+
+mime_types = {
+    'pdf': 'application/pdf',
+    'txt': 'text/plain',
+    'py': 'text/x-python',
+    'png': 'image/png',
+}
+
+
+class SyntheticSite:
+    """
+    All data a moodle would hand to a single teacher, generated from a seed.
+
+    Every course has `submissions` students, they are split into groups of `group_size`.
+    Single assignments get one submission per student, team assignments one per group.
+    Every submission has `files` files and, sometimes, an online text.
+    """
+    first_course_id = 1000
+    first_user_id = 10000
+    first_assignment_id = 100
+    first_context_id = 50000
+
+    def __init__(self, courses=2, assignments=5, submissions=50, files=2, team_ratio=0.5, group_size=3,
+                 graded_ratio=0.5, text_ratio=0.3, min_file_size=1024, max_file_size=256 * 1024,
+                 url='https://moodle.example.org', seed=0, now=None):
+        self.random = random.Random(seed)
+        self.url = url
+        self.now = now or int(time.time())
+        self.teacher_id = self.first_user_id - 1
+        self.file_sizes = {}  # file url: size
+
+        self.courses = []
+        self.users = {}  # course id: list of users
+        self.assignments = {}  # course id: list of assignments
+        self.submissions = {}  # assignment id: list of submissions
+        self.grades = {}  # assignment id: list of grades
+        self.groups = {}  # group id: group
+
+        user_id = self.first_user_id
+        assignment_id = self.first_assignment_id
+        for c in range(courses):
+            course_id = self.first_course_id + c
+            self.courses.append(self._course(course_id, c))
+
+            users, user_id = self._users(course_id, submissions, group_size, user_id)
+            self.users[course_id] = users
+
+            self.assignments[course_id] = []
+            for a in range(assignments):
+                is_team = self.random.random() < team_ratio
+                assignment = self._assignment(course_id, assignment_id, a, is_team)
+                self.assignments[course_id].append(assignment)
+                self.submissions[assignment_id], self.grades[assignment_id] = \
+                    self._submissions(assignment, users, files, graded_ratio, text_ratio,
+                                      min_file_size, max_file_size)
+                assignment_id += 1
+
+    def _course(self, course_id, number):
+        return {
+            'id': course_id,
+            'shortname': f'C{number:03d}',
+            'fullname': f'Synthetic Course {number:03d}',
+            'enrolledusercount': 0,
+            'idnumber': '',
+            'visible': 1,
+            'summary': '',
+            'summaryformat': 1,
+            'format': 'topics',
+        }
+
+    def _users(self, course_id, student_count, group_size, user_id):
+        users = [{'id': self.teacher_id, 'fullname': 'Synthetic Teacher', 'groups': []}]
+        group_count = max(1, -(-student_count // group_size))
+        groups = [{
+            'id': course_id * 10000 + g,
+            'name': f'Group {g:03d}',
+            'description': '',
+            'descriptionformat': 1
+        } for g in range(group_count)]
+        self.groups.update({g['id']: g for g in groups})
+        for s in range(student_count):
+            users.append({
+                'id': user_id,
+                'fullname': f'Student {user_id:06d}',
+                'groups': [groups[s // group_size]]
+            })
+            user_id += 1
+        return users, user_id
+
+    def _assignment(self, course_id, assignment_id, number, is_team):
+        due_date = self.now + self.random.randint(-60, 14) * 24 * 3600
+        configs = []
+        for n, (plugin, sub_type, name, value) in enumerate([
+            ('file', 'assignsubmission', 'enabled', '1'),
+            ('file', 'assignsubmission', 'maxfilesubmissions', '20'),
+            ('onlinetext', 'assignsubmission', 'enabled', '1'),
+            ('comments', 'assignfeedback', 'enabled', '1'),
+        ]):
+            configs.append({
+                'id': assignment_id * 10 + n,
+                'assignment': assignment_id,
+                'plugin': plugin,
+                'subtype': sub_type,
+                'name': name,
+                'value': value,
+            })
+        return {
+            'id': assignment_id,
+            'cmid': assignment_id + 5000,
+            'course': course_id,
+            'name': f'Assignment {number:02d}' + (' (team)' if is_team else ''),
+            'nosubmissions': 0,
+            'submissiondrafts': 0,
+            'sendnotifications': 0,
+            'sendlatenotifications': 0,
+            'sendstudentnotifications': 1,
+            'duedate': due_date,
+            'allowsubmissionsfromdate': due_date - 14 * 24 * 3600,
+            'grade': 10,
+            'timemodified': due_date - 21 * 24 * 3600,
+            'completionsubmit': 0,
+            'cutoffdate': 0,
+            'teamsubmission': 1 if is_team else 0,
+            'requireallteammemberssubmit': 0,
+            'teamsubmissiongroupingid': 0,
+            'blindmarking': 0,
+            'revealidentities': 0,
+            'attemptreopenmethod': 'none',
+            'maxattempts': -1,
+            'markingworkflow': 0,
+            'markingallocation': 0,
+            'requiresubmissionstatement': 0,
+            'configs': configs,
+            'intro': '{mlang en}Solve the exercises.{mlang}{mlang de}Löse die Aufgaben.{mlang}',
+            'introformat': 1,
+            'introattachments': [],
+        }
+
+    def _submissions(self, assignment, users, file_count, graded_ratio, text_ratio, min_size, max_size):
+        submissions = []
+        grades = []
+        assignment_id = assignment['id']
+        context_id = self.first_context_id + assignment_id
+        students = users[1:]
+
+        if assignment['teamsubmission']:
+            submitters = {}
+            for user in students:
+                group = user['groups'][0]
+                submitters.setdefault(group['id'], []).append(user)
+            submitter_list = [(0, group_id, members) for group_id, members in submitters.items()]
+        else:
+            submitter_list = [(user['id'], 0, [user]) for user in students]
+
+        for n, (user_id, group_id, members) in enumerate(submitter_list):
+            submission_id = assignment_id * 10000 + n
+            modified = assignment['duedate'] - self.random.randint(0, 7 * 24 * 3600)
+
+            files = []
+            for f in range(file_count):
+                extension = self.random.choice(list(mime_types))
+                name = f'solution_{f:02d}.{extension}'
+                url = f'{self.url}/webservice/pluginfile.php/{context_id:d}' \
+                      f'/assignsubmission_file/submission_files/{submission_id:d}/{name}'
+                size = self.random.randint(min_size, max_size)
+                self.file_sizes[url] = size
+                files.append({
+                    'filepath': '/',
+                    'filename': name,
+                    'filesize': size,
+                    'fileurl': url,
+                    'timemodified': modified,
+                    'mimetype': mime_types[extension],
+                })
+
+            text = ''
+            if file_count == 0 or self.random.random() < text_ratio:
+                text = f'<p>online text of submission {submission_id:d}</p>' * self.random.randint(1, 20)
+
+            submissions.append({
+                'id': submission_id,
+                'userid': user_id,
+                'attemptnumber': 0,
+                'timecreated': modified - 3600,
+                'timemodified': modified,
+                'status': 'submitted',
+                'groupid': group_id,
+                'plugins': [
+                    {
+                        'type': 'file',
+                        'name': 'File submissions',
+                        'fileareas': [{'area': 'submission_files', 'files': files}]
+                    },
+                    {
+                        'type': 'onlinetext',
+                        'name': 'Online text',
+                        'fileareas': [{'area': 'submissions_onlinetext', 'files': []}],
+                        'editorfields': [{
+                            'name': 'onlinetext',
+                            'description': 'Online text submissions',
+                            'text': text,
+                            'format': 1
+                        }]
+                    },
+                    {
+                        'type': 'comments',
+                        'name': 'Submission comments'
+                    },
+                ]
+            })
+
+            if self.random.random() < graded_ratio:
+                grade = f'{self.random.randint(0, 20) / 2:.5f}'
+                for member in members:
+                    grades.append({
+                        'id': submission_id * 10 + len(grades),
+                        'userid': member['id'],
+                        'attemptnumber': 0,
+                        'timecreated': modified + 3600,
+                        'timemodified': modified + 7200,
+                        'grader': self.teacher_id,
+                        'grade': grade,
+                    })
+
+        return submissions, grades
+
+    @property
+    def assignment_ids(self):
+        return list(self.submissions.keys())
+
+    def assignments_response(self, course_ids=None):
+        courses = []
+        for course in self.courses:
+            if course_ids and course['id'] not in course_ids:
+                continue
+            courses.append({
+                'id': course['id'],
+                'fullname': course['fullname'],
+                'shortname': course['shortname'],
+                'timemodified': self.now,
+                'assignments': self.assignments[course['id']],
+            })
+        return {'courses': courses, 'warnings': []}
+
+    def submissions_response(self, assignment_ids=None, since=0):
+        assignments = []
+        for assignment_id, submissions in self.submissions.items():
+            if assignment_ids and assignment_id not in assignment_ids:
+                continue
+            assignments.append({
+                'assignmentid': assignment_id,
+                'submissions': [s for s in submissions if s['timemodified'] >= since]
+            })
+        return {'assignments': assignments, 'warnings': []}
+
+    def grades_response(self, assignment_ids=None, since=0):
+        assignments = []
+        for assignment_id, grades in self.grades.items():
+            if assignment_ids and assignment_id not in assignment_ids:
+                continue
+            assignments.append({
+                'assignmentid': assignment_id,
+                'grades': [g for g in grades if g['timemodified'] >= since]
+            })
+        return {'assignments': assignments, 'warnings': []}
+
+    def file_content(self, url):
+        """deterministic content of a submission file, raises KeyError for unknown urls"""
+        size = self.file_sizes[url]
+        line = (url + '\n').encode()
+        return (line * (size // len(line) + 1))[:size]
+
+    def grading_file(self, assignment_id):
+        """a filled in grading file, as if written by pull and edited by a tutor"""
+        assignment = self._find_assignment(assignment_id)
+        users = {u['id']: u for u in self.users[assignment['course']]}
+        grades = []
+        for submission in self.submissions[assignment_id]:
+            if assignment['teamsubmission']:
+                name = self.groups[submission['groupid']]['name']
+            else:
+                name = users[submission['userid']]['fullname']
+            grades.append({
+                'name': name,
+                'id': submission['id'],
+                'grade': self.random.randint(0, 20) / 2,
+                'feedback': 'well done' * self.random.randint(0, 10)
+            })
+        return {'assignment_id': assignment_id, 'grades': grades}
+
+    def _find_assignment(self, assignment_id):
+        for assignments in self.assignments.values():
+            for assignment in assignments:
+                if assignment['id'] == assignment_id:
+                    return assignment
+        raise KeyError(assignment_id)
+
+    def write_worktree(self, root, with_grading_files=True, synced=True):
+        """
+        Writes the site as a synced work tree to root, the same files `mdt init` and `mdt sync` would write.
+        A local config with url, token and user_id is written too, so MoodleFrontend can be created.
+
+        :param root: the work tree root, is created if missing
+        :param with_grading_files: also write a grading file to each assignment folder
+        :param synced: if False, the work tree looks like right after `mdt init`
+        :return: the root path
+        """
+        import frontend  # noqa: F401, persistence.worktree can only be imported after frontend
+        from persistence.worktree import WorkTree
+
+        root = Path(root)
+        data = root / WorkTree.DATA_FOLDER
+        for folder in ['assignments', 'submissions', 'grades']:
+            (data / folder).mkdir(parents=True, exist_ok=True)
+
+        def dump(path, content):
+            with open(path, 'w') as file:
+                json.dump(content, file, indent=2, ensure_ascii=False, sort_keys=True)
+
+        dump(data / WorkTree.COURSES, self.courses)
+        dump(data / WorkTree.LOCAL_CONFIG, {
+            'url': self.url,
+            'token': 'synthetic-token',
+            'user_id': self.teacher_id,
+            'courseids': str([c['id'] for c in self.courses])
+        })
+        if not synced:
+            dump(data / WorkTree.USERS, [])
+            return root
+
+        dump(data / WorkTree.USERS, {str(k): v for k, v in self.users.items()})
+        for assignments in self.assignments.values():
+            for assignment in assignments:
+                dump(data / 'assignments' / str(assignment['id']), assignment)
+        for assignment_id, submissions in self.submissions.items():
+            dump(data / 'submissions' / str(assignment_id), submissions)
+        for assignment_id, grades in self.grades.items():
+            if len(grades) > 0:
+                dump(data / 'grades' / str(assignment_id), grades)
+        dump(data / 'submissions_meta', {'last_sync': self.now})
+        dump(data / 'grades_meta', {'last_sync': self.now})
+
+        if with_grading_files:
+            for assignments in self.assignments.values():
+                for a in assignments:
+                    folder = root / WorkTree.safe_file_name(f'{a["name"]}--{a["id"]:d}')
+                    folder.mkdir(exist_ok=True)
+                    dump(folder / 'gradingfile.json', self.grading_file(a['id']))
+        return root
+
+
+def add_scale_arguments(parser):
+    parser.add_argument('-c', '--courses', type=int, default=2, help='number of courses')
+    parser.add_argument('-a', '--assignments', type=int, default=5, help='assignments per course')
+    parser.add_argument('-s', '--submissions', type=int, default=50, help='students per course')
+    parser.add_argument('-f', '--files', type=int, default=2, help='files per submission')
+    parser.add_argument('--team-ratio', type=float, default=0.5, help='share of team assignments')
+    parser.add_argument('--group-size', type=int, default=3, help='students per group')
+    parser.add_argument('--graded-ratio', type=float, default=0.5, help='share of graded submissions')
+    parser.add_argument('--max-file-size', type=int, default=256 * 1024, help='largest file in bytes')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def site_from_arguments(args, **kwargs):
+    return SyntheticSite(courses=args.courses, assignments=args.assignments, submissions=args.submissions,
+                         files=args.files, team_ratio=args.team_ratio, group_size=args.group_size,
+                         graded_ratio=args.graded_ratio, max_file_size=args.max_file_size, seed=args.seed,
+                         **kwargs)
+
+
+def scale_of(args):
+    return {k: getattr(args, k) for k in ['courses', 'assignments', 'submissions', 'files', 'team_ratio',
+                                          'group_size', 'graded_ratio', 'max_file_size', 'seed']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='write a synthetic .mdt work tree')
+    parser.add_argument('target', help='the folder to create the work tree in')
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+
+    site = site_from_arguments(args)
+    root = site.write_worktree(args.target)
+    file_count = len(site.file_sizes)
+    print(f'wrote {root}: {len(site.courses):d} courses, {len(site.submissions):d} assignments, '
+          f'{sum(len(s) for s in site.submissions.values()):d} submissions, {file_count:d} files')
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+    main()
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""
+Times the hot paths of mdt on a synthetic work tree and writes the results as json.
+
+    python3 -m benchmarks.run --submissions 200 -o before.json
+    python3 -m benchmarks.run --submissions 200 -o after.json --compare before.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from unittest import mock
+
+repo_root = Path(__file__).resolve().parents[1]
+benchmarks = {}
+server_benchmarks = set()
+
+
+def benchmark(name, server=False):
+    """
+    registers fn(context) as benchmark. If it returns a callable, only that one is timed, fn is the setup.
+    If it returns a tuple (setup, run), setup is called untimed before every run.
+    Benchmarks with server=True talk to a benchmarks.server and only run with --server.
+    """
+    def register(fn):
+        benchmarks[name] = fn
+        if server:
+            server_benchmarks.add(name)
+        return fn
+    return register
+
+
+class Context:
+    def __init__(self, site, root, server=None):
+        self.site = site
+        self.root = root
+        self.server = server
+        self.e2e_root = root.parent / 'e2e'
+
+    def worktree(self):
+        from persistence.worktree import WorkTree
+        return WorkTree()
+
+    def reset_e2e_root(self, **kwargs):
+        shutil.rmtree(str(self.e2e_root), ignore_errors=True)
+        self.site.write_worktree(self.e2e_root, **kwargs)
+
+    @contextlib.contextmanager
+    def inside(self, path):
+        old = Path.cwd()
+        os.chdir(str(path))
+        try:
+            yield
+        finally:
+            os.chdir(str(old))
+
+
+# what `import mdt` may cost, measured by python -X importtime, and modules it must leave to the commands.
+startup_budget = 0.05
+startup_forbidden = ['requests', 'frontend.moodle', 'frontend.models', 'persistence.worktree', 'util.serialization']
+
+
+def startup_imports():
+    """:returns the cumulative import time of mdt in seconds and the names of all modules it imported"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import mdt'], cwd=str(repo_root),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    total, modules = 0.0, set()
+    for line in result.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        modules.add(name.strip())
+        if name.strip() == 'mdt':
+            total = int(cumulative) / 1e6
+    return total, modules
+
+
+@benchmark('startup_import')
+def bench_startup_import(ctx):
+    """fails, if the entry point imports more than the commands' parser needs, or takes longer than the budget"""
+    def run():
+        total, modules = startup_imports()
+        forbidden = [m for m in startup_forbidden if m in modules]
+        if len(forbidden) > 0:
+            raise RuntimeError(f'import mdt imports {", ".join(forbidden)}')
+        if total > startup_budget:
+            raise RuntimeError(f'import mdt took {total:.3f}s, budget: {startup_budget:.3f}s')
+    return run
+
+
+@benchmark('worktree_load')
+def bench_worktree_load(ctx):
+    return ctx.worktree
+
+
+@benchmark('worktree_data')
+def bench_worktree_data(ctx):
+    return lambda: ctx.worktree().data
+
+
+@benchmark('status')
+def bench_status(ctx):
+    from frontend import commands
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            commands.status()
+    return run
+
+
+@benchmark('status_full')
+def bench_status_full(ctx):
+    from frontend import commands
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            commands.status(full=True)
+    return run
+
+
+@benchmark('sync_merge_submissions')
+def bench_sync_submissions(ctx):
+    response = ctx.site.submissions_response()
+
+    def run():
+        ctx.worktree().submissions.update(response, ctx.site.now)
+    return run
+
+
+@benchmark('sync_merge_grades')
+def bench_sync_grades(ctx):
+    response = ctx.site.grades_response()
+
+    def run():
+        ctx.worktree().grades.update(response, ctx.site.now)
+    return run
+
+
+@benchmark('prepare_download')
+def bench_prepare_download(ctx):
+    def run():
+        wt = ctx.worktree()
+        assignments = []
+        for course in wt.data:
+            assignments += course.assignments.values()
+        wt.prepare_download(assignments)
+    return run
+
+
+@benchmark('parse_grade_files')
+def bench_parse_grade_files(ctx):
+    from frontend import MoodleFrontend
+    grading_files = sorted(ctx.root.glob('*/gradingfile.json'))
+
+    def run():
+        frontend = MoodleFrontend(ctx.worktree())
+        files = [open(f) for f in grading_files]
+        try:
+            with mock.patch('builtins.input', return_value='y'), contextlib.redirect_stdout(io.StringIO()):
+                frontend.parse_grade_files(files)
+        except SystemExit:
+            pass  # too large grades are reported by exiting, the work is done anyway.
+        finally:
+            for f in files:
+                f.close()
+    return run
+
+
+@benchmark('strip_mlang_plain')
+def bench_strip_mlang_plain(ctx):
+    """the full submissions response, which has no mlang tags"""
+    from moodle.parsers import strip_mlang
+    text = json.dumps(ctx.site.submissions_response())
+    return lambda: strip_mlang(text)
+
+
+@benchmark('strip_mlang_tagged')
+def bench_strip_mlang_tagged(ctx):
+    """the assignments response, every intro has en and de blocks"""
+    from moodle.parsers import strip_mlang
+    text = json.dumps(ctx.site.assignments_response())
+    return lambda: strip_mlang(text)
+
+
+@benchmark('strip_mlang_fields')
+def bench_strip_mlang_fields(ctx):
+    """decoded submissions and assignments responses, like MoodleSession with mlang_mode 'fields'"""
+    from moodle.parsers import strip_mlang_fields
+    texts = [json.dumps(ctx.site.submissions_response()), json.dumps(ctx.site.assignments_response())]
+    return lambda: [strip_mlang_fields(json.loads(t)) for t in texts]
+
+
+@benchmark('strip_mlang_text')
+def bench_strip_mlang_text(ctx):
+    """the same responses, stripped as text and decoded, like MoodleSession with mlang_mode 'text'"""
+    from moodle.parsers import strip_mlang
+    texts = [json.dumps(ctx.site.submissions_response()), json.dumps(ctx.site.assignments_response())]
+    return lambda: [json.loads(strip_mlang(t)) for t in texts]
+
+
+def worktree_json(ctx):
+    from util import serialization
+    return [serialization.read_file(f) for f in sorted((ctx.root / '.mdt').glob('**/*')) if f.is_file()]
+
+
+@benchmark('json_decode_worktree')
+def bench_json_decode_worktree(ctx):
+    """reads every json file in .mdt, with the backend chosen by util.serialization, see MDT_JSON_BACKEND"""
+    from util import serialization
+    files = [f for f in sorted((ctx.root / '.mdt').glob('**/*')) if f.is_file()]
+    return lambda: [serialization.read_file(f) for f in files]
+
+
+@benchmark('json_encode_worktree')
+def bench_json_encode_worktree(ctx):
+    from util import serialization
+    data = worktree_json(ctx)
+    return lambda: [serialization.dumpb(d, compact_output=False) for d in data]
+
+
+@benchmark('json_encode_compact')
+def bench_json_encode_compact(ctx):
+    from util import serialization
+    data = worktree_json(ctx)
+    return lambda: [serialization.dumpb(d, compact_output=True) for d in data]
+
+
+@benchmark('e2e_sync', server=True)
+def bench_e2e_sync(ctx):
+    from frontend import commands
+
+    def run():
+        with ctx.inside(ctx.e2e_root), contextlib.redirect_stdout(io.StringIO()):
+            commands.sync()
+    return lambda: ctx.reset_e2e_root(synced=False), run
+
+
+@benchmark('e2e_pull', server=True)
+def bench_e2e_pull(ctx):
+    from frontend import MoodleFrontend
+
+    def run():
+        with ctx.inside(ctx.e2e_root), contextlib.redirect_stdout(io.StringIO()):
+            MoodleFrontend().download_files()
+    return lambda: ctx.reset_e2e_root(with_grading_files=False), run
+
+
+@benchmark('e2e_pull_unchanged', server=True)
+def bench_e2e_pull_unchanged(ctx):
+    """a second pull, all files are in the download index already"""
+    from frontend import MoodleFrontend
+
+    def run():
+        with ctx.inside(ctx.e2e_root), contextlib.redirect_stdout(io.StringIO()):
+            MoodleFrontend().download_files()
+
+    def setup():
+        ctx.reset_e2e_root(with_grading_files=False)
+        run()
+    return setup, run
+
+
+@benchmark('e2e_sync_then_pull', server=True)
+def bench_e2e_sync_then_pull(ctx):
+    """sync, then pull, on a fresh work tree, to compare with e2e_pull_sync"""
+    from frontend import commands
+
+    def run():
+        with ctx.inside(ctx.e2e_root), contextlib.redirect_stdout(io.StringIO()):
+            commands.sync()
+            commands.pull()
+    return lambda: ctx.reset_e2e_root(synced=False), run
+
+
+@benchmark('e2e_pull_sync', server=True)
+def bench_e2e_pull_sync(ctx):
+    """pull --sync on a fresh work tree: downloads start as the submissions of each assignment arrive"""
+    from frontend import commands
+
+    def run():
+        with ctx.inside(ctx.e2e_root), contextlib.redirect_stdout(io.StringIO()):
+            commands.pull(sync=True)
+    return lambda: ctx.reset_e2e_root(synced=False), run
+
+
+@benchmark('e2e_grade', server=True)
+def bench_e2e_grade(ctx):
+    from frontend import MoodleFrontend
+
+    def run():
+        with ctx.inside(ctx.e2e_root), contextlib.redirect_stdout(io.StringIO()), \
+                mock.patch('builtins.input', return_value='y'):
+            frontend = MoodleFrontend()
+            files = [open(f) for f in sorted(Path.cwd().glob('*/gradingfile.json'))]
+            try:
+                frontend.upload_grades(frontend.parse_grade_files(files))
+            finally:
+                for f in files:
+                    f.close()
+    return ctx.reset_e2e_root, run
+
+
+def time_benchmark(fn, ctx, repeat):
+    timed = fn(ctx) or (lambda: fn(ctx))
+    setup = None
+    if isinstance(timed, tuple):
+        setup, timed = timed
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        timed()
+        timings.append(time.perf_counter() - start)
+    return {
+        'repeat': repeat,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+        'max': max(timings),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(repo_root),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except OSError:
+        return ''
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as file:
+        baseline = json.load(file)
+    print(f'{"benchmark":30} {"before":>10} {"after":>10} {"speedup":>8}')
+    for name, result in results['results'].items():
+        try:
+            before = baseline['results'][name]['median']
+        except KeyError:
+            continue
+        after = result['median']
+        print(f'{name:30} {before:10.4f} {after:10.4f} {before / after:7.2f}x')
+
+
+def main():
+    from benchmarks import generator
+    from benchmarks import server as server_module
+
+    parser = argparse.ArgumentParser(description='time mdt hot paths on a synthetic work tree')
+    generator.add_scale_arguments(parser)
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='runs per benchmark')
+    parser.add_argument('-b', '--benchmarks', nargs='+', choices=sorted(benchmarks), help='only run these')
+    parser.add_argument('-o', '--output', help='write json results to this file, default: stdout')
+    parser.add_argument('--compare', help='json results of an earlier run, to print speedups')
+    parser.add_argument('--keep', help='keep the work tree in this folder, instead of a temporary one')
+    parser.add_argument('--server', action='store_true',
+                        help='also run end to end benchmarks against a local benchmarks.server')
+    server_module.add_server_arguments(parser)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='mdt-bench-')
+    root = Path(args.keep or tmp) / 'worktree'
+    # keep the benchmark from finding or creating the users global config.
+    os.environ['XDG_CONFIG_HOME'] = tmp
+    (Path(tmp) / 'mdtconfig').write_text('{}')
+    old_cwd = Path.cwd()
+    server = None
+    try:
+        if args.server:
+            server = server_module.StubMoodleServer(latency=args.latency, bandwidth=args.bandwidth,
+                                                    error_rate=args.error_rate)
+            site = generator.site_from_arguments(args, url=server.url)
+            server.site = site
+            server.start()
+        else:
+            site = generator.site_from_arguments(args)
+        site.write_worktree(root)
+        os.chdir(str(root))
+        ctx = Context(site, root, server)
+
+        names = args.benchmarks or [n for n in benchmarks if args.server or n not in server_benchmarks]
+        results = {}
+        for name in names:
+            print(f'running {name}… ', end='', flush=True, file=sys.stderr)
+            results[name] = time_benchmark(benchmarks[name], ctx, args.repeat)
+            print(f'{results[name]["median"]:.4f}s', file=sys.stderr)
+    finally:
+        os.chdir(str(old_cwd))
+        shutil.rmtree(tmp, ignore_errors=True)
+        if server is not None:
+            server.stop()
+
+    from util import serialization
+    output = {
+        'revision': git_revision(),
+        'json_backend': serialization.backend,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': int(time.time()),
+        'scale': generator.scale_of(args),
+        'site': {
+            'submissions': sum(len(s) for s in site.submissions.values()),
+            'files': len(site.file_sizes),
+            'file_bytes': sum(site.file_sizes.values()),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(output, file, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+
+    if args.compare:
+        compare(output, args.compare)
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(repo_root))
+    main()
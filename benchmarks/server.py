@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the moodle endpoints MoodleSession uses, serving a SyntheticSite.
+
+    python3 -m benchmarks.server --port 8000 --latency 0.05 --bandwidth 1000000
+
+MoodleSession keeps plain http for localhost, point a work tree's url to http://localhost:8000.
+"""
+import argparse
+import email.parser
+import json
+import random
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+ws_path = '/webservice/rest/server.php'
+token_path = '/login/token.php'
+upload_path = '/webservice/upload.php'
+file_paths = ['/webservice/pluginfile.php/', '/pluginfile.php/']
+
+
+def moodle_exception(errorcode, message, exception='moodle_exception'):
+    return {'exception': exception, 'errorcode': errorcode, 'message': message}
+
+
+class StubMoodleHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like a real web server
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        self.server.count_request()
+
+        if self.server.latency > 0:
+            time.sleep(self.server.latency * (0.5 + self.server.random.random()))
+
+        if self.server.random.random() < self.server.error_rate:
+            self.send_body(b'<html><body>503 Service Unavailable</body></html>', status=503,
+                           content_type='text/html')
+            return
+
+        path = urlsplit(self.path).path
+        if path == ws_path:
+            self.web_service(parse_qs(body.decode(), keep_blank_values=True))
+        elif path == token_path:
+            self.send_json({'token': self.server.token})
+        elif path == upload_path:
+            self.upload(body)
+        elif any(path.startswith(p) for p in file_paths):
+            self.plugin_file(path, parse_qs(body.decode(), keep_blank_values=True))
+        else:
+            self.send_body(b'not found', status=404, content_type='text/plain')
+
+    def web_service(self, form):
+        def arg(name, default=None):
+            return form.get(name, [default])[0]
+
+        if arg('wstoken') != self.server.token:
+            self.send_json(moodle_exception('invalidtoken', 'Invalid token - token not found',
+                                            exception='webservice_access_exception'))
+            return
+        function = arg('wsfunction')
+        if function not in self.server.function_names:
+            self.send_json(moodle_exception('invalidrecord', f'Can not find data record in database table '
+                                                             f'external_functions. {function}'))
+            return
+        self.send_json(getattr(self.server.functions, function)(form))
+
+    def upload(self, body):
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        fields = {}
+        files = []
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            file_name = part.get_filename()
+            if file_name is None:
+                fields[name] = part.get_payload(decode=True).decode()
+            else:
+                files.append((file_name, len(part.get_payload(decode=True))))
+        if fields.get('token') != self.server.token:
+            self.send_json(moodle_exception('invalidtoken', 'Invalid token - token not found',
+                                            exception='webservice_access_exception'))
+            return
+        item_id = int(fields.get('itemid', 0)) or self.server.random.randint(1, 2 ** 30)
+        self.send_json([{
+            'component': 'user',
+            'contextid': 1,
+            'userid': str(self.server.site.teacher_id),
+            'filearea': fields.get('filearea', 'draft'),
+            'filename': file_name,
+            'filepath': fields.get('filepath', '/'),
+            'itemid': item_id,
+            'license': 'allrightsreserved',
+            'author': 'Synthetic Teacher',
+            'source': ''
+        } for file_name, size in files])
+
+    def plugin_file(self, path, form):
+        if form.get('token', [None])[0] != self.server.token:
+            self.send_json(moodle_exception('invalidtoken', 'Invalid token - token not found'), status=403)
+            return
+        url = self.server.site.url + path
+        try:
+            content = self.server.site.file_content(url)
+        except KeyError:
+            self.send_body(b'file not found', status=404, content_type='text/plain')
+            return
+        self.send_body(content, content_type='application/octet-stream')
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data).encode(), status=status, content_type='application/json')
+
+    def send_body(self, content, status=200, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+        bandwidth = self.server.bandwidth
+        if bandwidth <= 0:
+            self.wfile.write(content)
+            return
+        chunk_size = 16 * 1024
+        for start in range(0, len(content), chunk_size):
+            chunk = content[start:start + chunk_size]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / bandwidth)
+
+
+class WebServiceFunctions:
+    """one method per wsfunction, receiving the parsed form and returning the decoded payload"""
+
+    def __init__(self, server):
+        self.server = server
+
+    @property
+    def site(self):
+        return self.server.site
+
+    @staticmethod
+    def _ints(form, name):
+        return [int(v) for v in form.get(name, [])]
+
+    @staticmethod
+    def _int(form, name, default=0):
+        return int(form.get(name, [default])[0] or default)
+
+    def core_webservice_get_site_info(self, form):
+        return {
+            'sitename': 'Synthetic Moodle',
+            'username': 'teacher',
+            'firstname': 'Synthetic',
+            'lastname': 'Teacher',
+            'fullname': 'Synthetic Teacher',
+            'lang': 'en',
+            'userid': self.site.teacher_id,
+            'siteurl': self.site.url,
+            'userpictureurl': '',
+            'functions': [{'name': name, 'version': '2016052300'} for name in self.server.function_names],
+            'downloadfiles': 1,
+            'uploadfiles': 1,
+            'release': '3.1 (Build: 20160523)',
+            'version': '2016052300',
+        }
+
+    def core_enrol_get_users_courses(self, form):
+        return self.site.courses
+
+    def core_enrol_get_enrolled_users(self, form):
+        return self.site.users.get(self._int(form, 'courseid'), [])
+
+    def mod_assign_get_assignments(self, form):
+        return self.site.assignments_response(self._ints(form, 'courseids[]'))
+
+    def mod_assign_get_submissions(self, form):
+        return self.site.submissions_response(self._ints(form, 'assignmentids[]'), since=self._int(form, 'since'))
+
+    def mod_assign_get_grades(self, form):
+        return self.site.grades_response(self._ints(form, 'assignmentids[]'), since=self._int(form, 'since'))
+
+    def mod_assign_save_grade(self, form):
+        self.server.save_grade(self._int(form, 'assignmentid'), self._int(form, 'userid'),
+                               form.get('grade', ['0'])[0])
+        return None
+
+    def mod_assign_save_grades(self, form):
+        assignment_id = self._int(form, 'assignmentid')
+        num = 0
+        while f'grades[{num:d}][userid]' in form:
+            self.server.save_grade(assignment_id, self._int(form, f'grades[{num:d}][userid]'),
+                                   form.get(f'grades[{num:d}][grade]', ['0'])[0])
+            num += 1
+        return None
+
+    def core_files_get_files(self, form):
+        context_id = self._int(form, 'contextid')
+        item_id = self._int(form, 'itemid')
+        files = []
+        for url, size in self.site.file_sizes.items():
+            parts = url.split('/pluginfile.php/')[1].split('/')
+            if int(parts[0]) == context_id and int(parts[3]) == item_id:
+                files.append({
+                    'contextid': context_id,
+                    'component': parts[1],
+                    'filearea': parts[2],
+                    'itemid': item_id,
+                    'filepath': '/',
+                    'filename': parts[4],
+                    'isdir': 0,
+                    'url': url,
+                    'timemodified': self.site.now,
+                    'timecreated': self.site.now,
+                    'filesize': size,
+                    'author': 'Synthetic Student',
+                    'license': 'allrightsreserved',
+                })
+        return {'parents': [], 'files': files}
+
+
+class StubMoodleServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), site=None, token='synthetic-token', latency=0.0, bandwidth=0,
+                 error_rate=0.0, seed=0, verbose=False):
+        """
+        :param address: host and port to bind, port 0 picks a free one
+        :param site: the SyntheticSite to serve, can be set after binding, as its urls need the port
+        :param token: the only accepted token
+        :param latency: mean seconds to wait before answering a request
+        :param bandwidth: bytes per second per connection, 0 for unlimited
+        :param error_rate: share of requests answered with 503
+        """
+        super().__init__(address, StubMoodleHandler)
+        self.site = site
+        self.token = token
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.verbose = verbose
+        self.random = random.Random(seed)
+        self.functions = WebServiceFunctions(self)
+        self.function_names = sorted(n for n in dir(WebServiceFunctions) if not n.startswith('_') and n != 'site')
+        self.request_count = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port:d}'
+
+    def count_request(self):
+        with self._lock:
+            self.request_count += 1
+
+    def save_grade(self, assignment_id, user_id, grade):
+        now = int(time.time())
+        with self._lock:
+            grades = self.site.grades.setdefault(assignment_id, [])
+            for g in grades:
+                if g['userid'] == user_id:
+                    g['grade'] = f'{float(grade):.5f}'
+                    g['timemodified'] = now
+                    g['grader'] = self.site.teacher_id
+                    return
+            grades.append({
+                'id': assignment_id * 100000 + len(grades),
+                'userid': user_id,
+                'attemptnumber': 0,
+                'timecreated': now,
+                'timemodified': now,
+                'grader': self.site.teacher_id,
+                'grade': f'{float(grade):.5f}',
+            })
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds per request')
+    parser.add_argument('--bandwidth', type=int, default=0, help='bytes per second per connection, 0: unlimited')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests failing with 503')
+
+
+def main():
+    from benchmarks import generator
+
+    parser = argparse.ArgumentParser(description='serve a synthetic moodle on localhost')
+    generator.add_scale_arguments(parser)
+    add_server_arguments(parser)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--worktree', help='also write a matching work tree to this folder')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    server = StubMoodleServer((args.host, args.port), latency=args.latency, bandwidth=args.bandwidth,
+                              error_rate=args.error_rate, verbose=args.verbose)
+    server.site = generator.site_from_arguments(args, url=server.url)
+    if args.worktree:
+        server.site.write_worktree(args.worktree, with_grading_files=False)
+        print(f'wrote work tree to {args.worktree}')
+    print(f'serving on {server.url}, token: {server.token}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f'served {server.request_count:d} requests')
+        server.server_close()
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+    main()
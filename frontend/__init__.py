@@ -1,2 +1,6 @@
-from frontend.moodle import MoodleFrontend
-
+def __getattr__(name):
+    # imported on first use, so light modules like frontend.cmdparser don't pull in requests.
+    if name == 'MoodleFrontend':
+        from frontend.moodle import MoodleFrontend
+        return MoodleFrontend
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
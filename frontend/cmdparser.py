@@ -47,5 +47,6 @@ class ParserManager:
             for arg in arguments:
                 arg.add_to_parser(sub)
             sub.set_defaults(func=decorated_fn)
+            return decorated_fn
 
         return register_function
@@ -5,18 +5,15 @@
 # unittests https://docs.python.org/3/library/unittest.html
 import argparse
 import getpass
-import json
-import logging
 import shutil
 
-from frontend import MoodleFrontend
-from frontend.models import Course, Assignment
 from moodle.fieldnames import JsonFieldNames as Jn, text_format
-from persistence.worktree import WorkTree
-from util import interaction
+from util.transfer import parse_size, smallest_first, assignments_first
 from frontend.cmdparser import ParserManager, Argument, ArgumentGroup
 
-log = logging.getLogger('wstools')
+# every command imports what it needs itself: building the parser for all of them must not import requests,
+# the models and the work tree, most of mdt's start up time.
+
 pm = ParserManager('wstools', 'internal sub command help')
 
 
@@ -45,6 +42,10 @@ def auth(url=None, ask=False, username=None, service='moodle_mobile_app', local=
     :return: nothing.
     """
 
+    from frontend import MoodleFrontend
+    from persistence.worktree import WorkTree
+    from util import interaction
+
     _url = 'url'
     _user = 'user_name'
     _service = 'service'
@@ -95,6 +96,10 @@ def auth(url=None, ask=False, username=None, service='moodle_mobile_app', local=
 def init(force=False, course_ids=None):
     """initializes working tree: creates local .mdt/config, with chosen courses"""
 
+    from frontend import MoodleFrontend
+    from persistence.worktree import WorkTree
+    from util import interaction
+
     try:
         wt = WorkTree(init=True, force=force)
     except FileExistsError:
@@ -135,12 +140,22 @@ def init(force=False, course_ids=None):
     Argument('-f', '--files', help='sync file metadata', action='store_true', default=False)
 )
 def sync(assignments=False, submissions=False, grades=False, users=False, files=False):
+    from frontend import MoodleFrontend
     frontend = MoodleFrontend()
 
     sync_all = True
     if users or submissions or assignments or grades or files:
         sync_all = False
 
+    needed = {
+        'mod_assign_get_assignments': assignments or sync_all,
+        'mod_assign_get_submissions': submissions or sync_all,
+        'mod_assign_get_grades': grades or sync_all,
+        'core_enrol_get_enrolled_users': users or sync_all,
+        'core_files_get_files': files,
+    }
+    frontend.require(*[name for name, used in needed.items() if used])
+
     if assignments or sync_all:
         print('syncing assignments… ', end='', flush=True)
         output = frontend.sync_assignments()
@@ -161,10 +176,10 @@ def sync(assignments=False, submissions=False, grades=False, users=False, files=
         output = frontend.sync_users()
         print(output + 'finished.')
 
-    if files:  # TODO: when finished, add 'or sync_all'
-        print('syncing files… ', end='', flush=True)
-        frontend.sync_file_meta_data()
-        print('finished')
+    if files:  # not part of sync_all, it needs one request per submission.
+        print('syncing file meta data… ', flush=True)
+        output = frontend.sync_file_meta_data()
+        print('finished. ' + ' '.join(output))
 
 
 @pm.command(
@@ -176,6 +191,8 @@ def sync(assignments=False, submissions=False, grades=False, users=False, files=
     Argument('--full', help='display all assignments', action='store_true')
 )
 def status(assignment_ids=None, submission_ids=None, full=False):
+    from frontend.models import Course, Assignment
+    from persistence.worktree import WorkTree
     wt = WorkTree()
     term_columns = shutil.get_terminal_size().columns
 
@@ -215,23 +232,136 @@ def status(assignment_ids=None, submission_ids=None, full=False):
 @pm.command(
     'retrieve files for grading',
     Argument('assignment_ids', nargs='*', type=int),
-    Argument('--all', help='pull all due submissions, even old ones', action='store_true')
+    Argument('--all', help='pull all submissions, not only new and ungraded ones', action='store_true'),
+    Argument('--order', choices=[smallest_first, assignments_first], default=smallest_first,
+             help='download small files first, or the assignments in the order given, default: %(default)s'),
+    Argument('--rate', type=parse_size, default=None,
+             help='bytes per second for all downloads together, like 500k or 2M, default: download_rate config'),
+    Argument('--max-file-size', type=parse_size, default=0, help='skip files larger than this, like 50M'),
+    Argument('--mimetype', dest='mime_types', action='append', metavar='TYPE',
+             help='only files of this mime type, like application/pdf or image/*, repeatable'),
+    Argument('--name', dest='names', action='append', metavar='GLOB',
+             help='only files whose name matches, like *.pdf, repeatable'),
+    Argument('--group', dest='groups', action='append', help='only submissions of this group, name or id, repeatable'),
+    Argument('--user', dest='users', action='append', help='only submissions of this user, name or id, repeatable'),
+    Argument('-n', '--dry-run', action='store_true', help='print how many files and bytes would be downloaded'),
+    Argument('--sync', action='store_true',
+             help='sync first, downloading the files of each assignment as soon as its submissions arrive'),
+)
+def pull(assignment_ids=None, all=False, order=smallest_first, rate=None, max_file_size=0, mime_types=None,
+         names=None, groups=None, users=None, dry_run=False, sync=False):
+    from frontend import MoodleFrontend
+    from frontend.moodle import PullFilter
+    frontend = MoodleFrontend()
+    if rate is None:
+        rate = frontend.config.download_rate
+
+    pull_filter = PullFilter(mime_types=mime_types, names=names, groups=groups, users=users)
+    if sync and not dry_run:
+        frontend.require('mod_assign_get_assignments', 'mod_assign_get_submissions', 'mod_assign_get_grades',
+                         'core_enrol_get_enrolled_users')
+        frontend.sync_and_download_files(assignment_ids, all_submissions=all, rate=rate,
+                                         max_file_size=max_file_size, pull_filter=pull_filter)
+        return
+
+    frontend.download_files(assignment_ids, all_submissions=all, order=order, rate=rate,
+                            max_file_size=max_file_size, pull_filter=pull_filter, dry_run=dry_run)
+
+
+@pm.command(
+    'keep polling moodle for new submissions and grades, and download new files as they appear',
+    Argument('assignment_ids', nargs='*', type=int, help='assignments to watch, default: all'),
+    Argument('--interval', type=float, default=30,
+             help='seconds between polls of active assignments, default: %(default)s'),
+    Argument('--max-interval', type=float, default=600,
+             help='quiet assignments are polled less often, up to every that many seconds, default: %(default)s'),
+    Argument('--log', dest='log_file', metavar='FILE', help='append the events to FILE'),
+    Argument('--no-download', dest='download', action='store_false', help='only log, download nothing'),
 )
-def pull(assignment_ids=None, all=False):
+def watch(assignment_ids=None, interval=30, max_interval=600, log_file=None, download=True):
+    from frontend import MoodleFrontend
+    from frontend.watch import Watcher
     frontend = MoodleFrontend()
+    frontend.require('mod_assign_get_submissions', 'mod_assign_get_grades')
 
-    frontend.download_files(assignment_ids)
+    watcher = Watcher(frontend, assignment_ids, min_interval=interval, max_interval=max_interval,
+                      download=download, log_file=log_file)
+    watcher.run()
+
+
+@pm.command(
+    'keep mdt and this work tree loaded in the background, status, sync and pull then start faster',
+    Argument('--idle', type=float, default=900, help='stop after that many seconds without commands, '
+                                                     'default: %(default)s'),
+    Argument('--detach', action='store_true', help='run in the background and return at once'),
+    Argument('--stop', action='store_true', help='stop the running server of this work tree'),
+)
+def serve(idle=900, detach=False, stop=False):
+    import subprocess
+    import sys
+    from persistence.worktree import WorkTree
+    from util import server
+    wt = WorkTree()
+    if stop:
+        print('stopped' if server.stop_remote(wt.root) else 'no server running')
+    elif detach:
+        subprocess.Popen([sys.executable, sys.argv[0], 'serve', '--idle', str(idle)], cwd=str(wt.root),
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+    else:
+        print(f'serving {wt.root}, stops after {idle:.0f}s without commands')
+        server.serve(wt.root, idle_timeout=idle)
 
 
 @pm.command(
     'upload grades from files',
-    Argument('grading_files', nargs='+', help='files containing grades', type=argparse.FileType())
+    Argument('grading_files', nargs='*', help='files containing grades', type=argparse.FileType()),
+    Argument('--resume', action='store_true',
+             help='upload what the last, interrupted upload did not, with grading files: skip grades it uploaded'),
+    Argument('--all', dest='all_grades', action='store_true',
+             help='upload every grade, not only those that differ from moodle\'s and the last upload'),
+    Argument('--force', action='store_true',
+             help='overwrite grades someone else changed on moodle after the grade they are based on'),
 )
-def grade(grading_files):
+def grade(grading_files=None, resume=False, all_grades=False, force=False):
+    from frontend import MoodleFrontend
+    if not grading_files and not resume:
+        print('give grading files, or --resume to continue the last upload')
+        raise SystemExit(1)
     frontend = MoodleFrontend()
-    upload_data = frontend.parse_grade_files(grading_files)
+    frontend.grade_upload_function()  # refuse before asking, if grades can't be uploaded.
+    if not grading_files:
+        frontend.resume_grade_upload()
+        return
+
+    upload_plan = frontend.parse_grade_files(grading_files)
+    frontend.upload_grades(upload_plan, resume=resume, all_grades=all_grades, force=force)
+
 
-    frontend.upload_grades(upload_data)
+@pm.command(
+    'merge an offline grading worksheet into a moodle export, for grading without web services',
+    Argument('grading_file', help='csv file containing your grades'),
+    Argument('moodle_file', help='csv file exported from moodle'),
+    Argument('-o', '--output', dest='result_file', help='file to write the merged csv to', required=True),
+    Argument('-s', '--single', help='match on "Vollständiger Name" instead of "Gruppe"', action='store_true'),
+    Argument('--no-feedback', dest='feedback', help='grading file has no feedback column', action='store_false')
+)
+def destroy(grading_file, moodle_file, result_file, single=False, feedback=True):
+    from util import csvmerge
+    written, unmatched_grading, unmatched_moodle, duplicates = csvmerge.merge_files(
+        grading_file, moodle_file, result_file, single=single, feedback=feedback)
+
+    print(f'wrote {written:d} rows to {result_file}')
+    for key in duplicates:
+        print(f'  duplicate in grading file, using last: {key}')
+    if len(unmatched_grading) > 0:
+        print(f'{len(unmatched_grading):d} entries of the grading file were not found in the moodle export:')
+        for key in unmatched_grading:
+            print('  ' + key)
+    if len(unmatched_moodle) > 0:
+        print(f'{len(unmatched_moodle):d} entries of the moodle export were not found in the grading file:')
+        for key in unmatched_moodle:
+            print('  ' + key)
 
 
 @pm.command(
@@ -239,6 +369,7 @@ def grade(grading_files):
     Argument('files', nargs='+', help='files to upload', type=argparse.FileType('rb'))
 )
 def upload(files):
+    from frontend import MoodleFrontend
     frontend = MoodleFrontend(True)  # TODO: HACK, for not initializing worktree
     frontend.upload_files(files)
 
@@ -248,6 +379,8 @@ def upload(files):
     Argument('keywords', nargs='+', help='some words to search for')
 )
 def enrol(keywords):
+    from frontend import MoodleFrontend
+    from util import interaction, serialization
     frontend = MoodleFrontend(True)
     data = frontend.search_courses_by_keywords(keywords)
     courses = [c for c in data['courses']]
@@ -276,7 +409,7 @@ def enrol(keywords):
     enrolment_methods = frontend.get_course_enrolment_methods(chosen_course[Jn.id])
     chosen_method_instance_id = None
     if len(enrolment_methods) > 1:
-        print(json.dumps(enrolment_methods, indent=2, sort_keys=True))
+        print(serialization.dumps(enrolment_methods))
         # todo: let user choose enrolment method
         raise NotImplementedError('there are multiple enrolment methods, please send this output as bugreport')
     elif len(enrolment_methods) == 1:
@@ -330,6 +463,11 @@ def submit(text=None, textfiles=None, files=None, assignment_id=None):
     }
     ]"""
 
+    from frontend import MoodleFrontend
+    from frontend.models import Assignment
+    from persistence.worktree import WorkTree
+    from util import interaction
+
     def determine_text_format_id(file_name):
         ending = file_name.split('.')[-1]
         if 'md' == ending:
@@ -386,6 +524,7 @@ def submit(text=None, textfiles=None, files=None, assignment_id=None):
     'dump course contents, work in progress'
 )
 def dump():
+    from frontend import MoodleFrontend
     frontend = MoodleFrontend()
 
     frontend.get_course_content()
@@ -395,6 +534,7 @@ def dump():
     'dump config'
 )
 def config():
+    from persistence.worktree import WorkTree
     print(WorkTree.get_global_config_values())
     for cfg in WorkTree.get_config_file_list():
         print(cfg)
@@ -53,6 +53,42 @@ class GlobalConfig(JsonDictWrapper):
     @property
     def user_name(self): return self['user_name']
 
+    @property
+    def preferred_language(self):
+        """the language kept from {mlang} multi language texts, set 'preferred_language' in a config"""
+        return self.get('preferred_language', 'en')
+
+    @property
+    def mlang_mode(self):
+        """'text' strips {mlang} tags from whole responses, 'fields' only from names, intros and editor fields"""
+        return self.get('mlang_mode', 'text')
+
+    @property
+    def max_workers(self):
+        """threads for downloads and uploads, also the number of connections kept open to moodle"""
+        return int(self.get('max_workers', 10))
+
+    @property
+    def retries(self):
+        """how often failed requests are retried"""
+        return int(self.get('retries', 0))
+
+    @property
+    def download_rate(self):
+        """bytes per second all downloads of pull may use together, like '2M', 0 for no limit"""
+        from util.transfer import parse_size
+        return parse_size(self.get('download_rate', 0))
+
+    @property
+    def cache_ttl(self):
+        """seconds site info, course lists and enrolment methods are cached, 0 disables the cache"""
+        return int(self.get('cache_ttl', 600))
+
+    @property
+    def compact_storage(self):
+        """write the synced data in .mdt without indentation and sorting, faster but less readable"""
+        return self.get('compact_storage', False)
+
     def add_overrides(self, overrides):
         if overrides is not None:
             self._data.update(overrides)
@@ -95,6 +131,11 @@ class GradingFile(JsonDictWrapper):
             @property
             def feedback(self): return self['feedback']
 
+            @property
+            def time_modified(self):
+                """moodle's timemodified of the grade this one was based on, when pulled. None in older files"""
+                return self.get('timemodified', None)
+
 
 class Course(MoodleCourse):
     def __init__(self, data):
@@ -239,7 +280,7 @@ class Assignment(MoodleAssignment):
         # TODO, add team_submission to the file, saves work when uploading grades.
         head = '{{"assignment_id": {:d}, "grades": [\n'
         end = '\n]}'
-        line_format = '{{"name": "{}", "id": {:d}, "grade": {:3.1f}, "feedback":"" }}'
+        line_format = '{{"name": "{}", "id": {:d}, "grade": {:3.1f}, "feedback":"", "timemodified": {:d} }}'
         content = []
 
         if self.is_team_submission:
@@ -248,17 +289,17 @@ class Assignment(MoodleAssignment):
                     # FIXME: invalid grouping
                     continue
                 group = self.course.groups[s.group_id]
-                grade = 0.0
+                grade, time_modified = 0.0, 0
                 if s.grade is not None:
-                    grade = s.grade.value
-                content.append(line_format.format(group.name, s.id, grade))
+                    grade, time_modified = s.grade.value, s.grade.time_modified
+                content.append(line_format.format(group.name, s.id, grade, time_modified))
         else:
             for s_id, s in self.submissions.items():
                 user = self.course.users[s.user_id]
-                grade = 0.0
+                grade, time_modified = 0.0, 0
                 if s.grade is not None:
-                    grade = s.grade.value
-                content.append(line_format.format(user.name, s.id, grade))
+                    grade, time_modified = s.grade.value, s.grade.time_modified
+                content.append(line_format.format(user.name, s.id, grade, time_modified))
 
         return head.format(self.id) + ',\n'.join(sorted(content)) + end
 
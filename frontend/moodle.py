@@ -1,24 +1,234 @@
 import concurrent.futures as cf
-import json
+import fnmatch
 from datetime import datetime
 import math
+import mimetypes
+import threading
 
 import moodle.models as models
-from frontend.models import Submission, GradingFile, Assignment, Course
-from moodle.exceptions import AccessDenied, InvalidResponse
+from frontend.models import Submission, GradingFile, Grade
+from moodle.exceptions import AccessDenied, DownloadFailed, FileTooLarge, FunctionNotAvailable, InvalidResponse, \
+    MoodleException
+from moodle.fieldnames import JsonFieldNames as Jn
+from persistence.models import file_meta_key
 from persistence.worktree import WorkTree
-from util import interaction
+from util import interaction, serialization
+from util.transfer import TokenBucket, TransferMeter, format_duration, format_size, smallest_first, assignments_first
 
-MAX_WORKERS = 10
+# keyword arguments for every MoodleSession the frontend creates, set by mdt's global options.
+session_options = {}
+
+# sessions by their arguments, frontends with the same config share one, so its connections stay open between
+# the phases of a command, like syncing and pulling.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def shared_session(**kwargs):
+    from moodle.communication import MoodleSession
+    kwargs.update(session_options)
+    key = tuple(sorted(kwargs.items()))
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = MoodleSession(**kwargs)
+        return session
+
+
+class PlannedDownload:
+    """a submission file pull is going to download, with its size, timemodified and contenthash if known"""
+
+    def __init__(self, file, key, size, time_modified, content_hash):
+        self.file = file
+        self.key = key
+        self.size = size
+        self.time_modified = time_modified
+        self.content_hash = content_hash
+
+    @property
+    def known_size(self):
+        """the size, 0 if moodle didn't tell"""
+        return self.size if self.size is not None and self.size > 0 else 0
+
+    @property
+    def assignment_id(self):
+        return self.file.submission.assignment.id
+
+
+class PullFilter:
+    """
+    Selects the submissions and files pull plans: each given criterion has to match, for one criterion
+    matching any of its values is enough. Groups and users match by id or name, ignoring case,
+    mime types and file names are shell patterns, like 'image/*' or '*.pdf'.
+    """
+
+    def __init__(self, mime_types=None, names=None, groups=None, users=None):
+        self.mime_types = mime_types or []
+        self.names = names or []
+        self.groups = [str(g).casefold() for g in groups or []]
+        self.users = [str(u).casefold() for u in users or []]
+
+    @property
+    def is_active(self):
+        return len(self.mime_types + self.names + self.groups + self.users) > 0
+
+    @staticmethod
+    def _named(values, candidates):
+        return any(str(c.id) in values or c.name.casefold() in values for c in candidates)
+
+    def includes_submission(self, submission):
+        course = submission.assignment.course
+        if submission.assignment.is_team_submission:
+            group = course.groups.get(submission.group_id)
+            groups = [] if group is None else [group]
+            users = [] if group is None else group.members
+        else:
+            user = course.users.get(submission.user_id)
+            users = [] if user is None else [user]
+            groups = [] if user is None else user.groups.values()
+        if len(self.groups) > 0 and not self._named(self.groups, groups):
+            return False
+        if len(self.users) > 0 and not self._named(self.users, users):
+            return False
+        return True
+
+    def includes_file(self, file):
+        if len(self.names) > 0 and not any(fnmatch.fnmatch(file.name, n) for n in self.names):
+            return False
+        if len(self.mime_types) > 0:
+            mime_type = file.get(Jn.mime_type, None) or mimetypes.guess_type(file.name)[0] or ''
+            if not any(fnmatch.fnmatch(mime_type, m) for m in self.mime_types):
+                return False
+        return True
+
+
+class DownloadRun:
+    """
+    Downloads running on an executor: verified, moved into place and recorded in the download index as they
+    complete, in the thread calling finish. Files can be added while others are running.
+    """
+
+    def __init__(self, frontend, executor, downloads, rate=0, max_file_size=0):
+        self.frontend = frontend
+        self.executor = executor
+        self.downloads = downloads
+        self.max_file_size = max_file_size
+        self.throttle = TokenBucket(rate) if rate > 0 else None
+        self.meter = TransferMeter()
+        self.futures = {}  # future: PlannedDownload
+        self.finished = 0
+        self.failed = []
+        self.failed_assignments = set()
+
+    def add(self, planned):
+        if len(planned) == 0:
+            return
+        self.frontend.worktree.create_folders([p.file for p in planned])
+        for p in planned:
+            self.meter.total_bytes += p.known_size
+            future = self.executor.submit(self.frontend._download_verified, p.file, p.size, p.content_hash,
+                                          throttle=self.throttle, meter=self.meter, max_size=self.max_file_size)
+            self.futures[future] = p
+
+    def finish(self, future):
+        p = self.futures.pop(future)
+        self.finished += 1
+        try:
+            received_size, sha1 = future.result()
+        except DownloadFailed as e:
+            self.failed.append(str(e))
+            self.failed_assignments.add(p.assignment_id)
+            return
+        worktree = self.frontend.worktree
+        worktree.store_submission_file(p.file)
+        self.downloads.add(p.key, p.file.path.relative_to(worktree.root), received_size, p.time_modified, sha1)
+
+    def print_progress(self):
+        total = self.finished + len(self.futures)
+        if total > 0:
+            interaction.print_progress(self.finished, total, suffix=self.meter)
+
+    def report_failures(self):
+        """prints the failed downloads, :returns the ids of their assignments"""
+        for message in self.failed:
+            print(message)
+        return self.failed_assignments
+
+
+class GradingIndex:
+    """
+    What grading files are checked against, built once per grade run from the raw work tree data:
+    the assignments, and for each of their submissions the user its grade is uploaded for,
+    the submitter, or for team submissions the first member of the group.
+    """
+
+    def __init__(self, worktree, assignment_ids):
+        self.assignments = {}
+        self.recipients = {}  # assignment id: {submission id: user id, None for submissions of unknown groups}
+        first_members = {}  # course id: {group id: user id}
+        for as_id in assignment_ids:
+            try:
+                assignment = models.MoodleAssignment(worktree.assignments[as_id])
+            except KeyError:
+                continue
+            self.assignments[as_id] = assignment
+            if assignment.is_team_submission and assignment.course_id not in first_members:
+                members = first_members[assignment.course_id] = {}
+                for user in worktree.users.get(str(assignment.course_id), []):
+                    user = models.MoodleUser(user)
+                    for group in user.groups:
+                        members.setdefault(group.id, user.id)
+
+            recipients = self.recipients[as_id] = {}
+            for submission in models.MoodleSubmissionList(worktree.submissions.get(as_id, [])):
+                if assignment.is_team_submission:
+                    recipients[submission.id] = first_members[assignment.course_id].get(submission.group_id)
+                else:
+                    recipients[submission.id] = submission.user_id
 
 
 class MoodleFrontend:
     def __init__(self, worktree=None):
         # todo, read course from worktree config.
-        from moodle.communication import MoodleSession
-        self.worktree = worktree or WorkTree()
         self.config = WorkTree.get_global_config_values()
-        self.session = MoodleSession(moodle_url=self.config.url, token=self.config.token)
+        self.worktree = worktree or WorkTree(compact_storage=self.config.compact_storage)
+        self.max_workers = self.config.max_workers
+        self.session = shared_session(moodle_url=self.config.url, token=self.config.token,
+                                      preferred_lang=self.config.preferred_language,
+                                      mlang_mode=self.config.mlang_mode,
+                                      pool_size=self.max_workers, retries=self.config.retries,
+                                      cache_ttl=self.config.cache_ttl)
+        self._functions = None
+        self._functions_probed = False
+
+    @property
+    def available_functions(self):
+        """
+        names of the functions the web service of the token offers, from the site info.
+        None if they can't be found out, e.g. when replaying a cassette without the site info.
+        """
+        if not self._functions_probed:
+            from moodle.cassette import CassetteMiss
+            try:
+                info = self.session.core_webservice_get_site_info()
+                self._functions = frozenset(f[Jn.name] for f in info.get(Jn.functions, []))
+            except (MoodleException, CassetteMiss):
+                self._functions = None
+            self._functions_probed = True
+        return self._functions
+
+    def has_function(self, name):
+        functions = self.available_functions
+        return functions is not None and name in functions
+
+    def require(self, *names):
+        """refuses early, with FunctionNotAvailable, if the service is known to lack one of the functions"""
+        functions = self.available_functions
+        if functions is None:
+            return
+        missing = set(names) - functions
+        if len(missing) > 0:
+            raise FunctionNotAvailable(missing)
 
     @property
     def course_ids(self):
@@ -45,7 +255,7 @@ class MoodleFrontend:
         for cid in self.course_ids:
             try:
                 response = self.session.core_enrol_get_enrolled_users(course_id=cid, options=options)
-                users[int(cid)] = response
+                users[str(cid)] = response  # as read back from json, WorkTree.data looks them up so.
                 output += f'{cid:5d}:got {len(response):4d}\n'
             except AccessDenied as denied:
                 message = f'{cid:d} denied access to users: {denied}\n'
@@ -78,40 +288,153 @@ class MoodleFrontend:
         return wrapped
 
     def sync_file_meta_data(self):
-        files = []
+        """
+        Requests the meta data of all submission files, one core_files_get_files call per file area,
+        as all files of a submission share one, and stores it per assignment.
+        """
+        now = math.floor(datetime.now().timestamp())
+        areas = {}  # (context_id, item_id, component, file_area): assignment id
         for as_id, submissions in self.worktree.submissions.items():
             for submission in submissions:
-                files += Submission(submission).files
-            with cf.ThreadPoolExecutor(max_workers=MAX_WORKERS) as tpe:
+                for plugin in Submission(submission).plugins:
+                    for file in plugin.files:
+                        params = file.meta_data_params
+                        key = (int(params['context_id']), int(params['item_id']), params['component'],
+                               params['file_area'])
+                        areas.setdefault(key, as_id)
+
+        files = {}
+        area_count = len(areas)
+        counter = 0
+        if area_count > 0:
+            interaction.print_progress(counter, area_count)
+            with cf.ThreadPoolExecutor(max_workers=self.max_workers) as tpe:
                 try:
-                    future_to_file = {tpe.submit(self.session.core_files_get_files, **file.meta_data_params): file for file in files}
-                    for future in cf.as_completed(future_to_file):
-                        file = future_to_file[future]
+                    future_to_area = {}
+                    for key, as_id in areas.items():
+                        context_id, item_id, component, file_area = key
+                        future = tpe.submit(self.session.core_files_get_files, context_id, item_id,
+                                            component=component, file_area=file_area)
+                        future_to_area[future] = (key, as_id)
+                    for future in cf.as_completed(future_to_area):
+                        key, as_id = future_to_area[future]
                         response = models.FileMetaDataResponse(future.result())
-                        for file in response.files:
-                            print(file)
+                        files.setdefault(as_id, []).extend(f.raw for f in response.files if not f.isdir)
+                        counter += 1
+                        interaction.print_progress(counter, area_count)
                 except KeyboardInterrupt:
                     print('stopping…')
                     tpe.shutdown()
                     raise
 
+        result = self.worktree.file_meta.update(files, now)
+        output = ['{}: {:d}'.format(k, v) for k, v in result.items()]
+        return output
 
-
-
-        # for file in files:
-        #     wrapped = models.FileMetaDataResponse(self.session.core_files_get_files(**file.meta_data_params))
-        #     print(str(wrapped.raw))
-        #     for received in wrapped.files:
-        #         print(received.author)
-
-            # reply = moodle.get_submissions_for_assignments(wt.assignments.keys())
-            # data = json.loads(strip_mlang(reply.text))
-            # result = wt.submissions.update(data)
-            # output = ['{}: {:d}'.format(k, v) for k, v in result.items()]
-            # print('finished. ' + ' '.join(output))
-
-    def download_files(self, assignment_ids=None):
-        courses = self.worktree.data
+    def download_files(self, assignment_ids=None, all_submissions=False, order=smallest_first, rate=0,
+                       max_file_size=0, pull_filter=None, dry_run=False):
+        """
+        :param all_submissions: every submission, not only those changed since the last pull or still ungraded
+        :param pull_filter: a PullFilter, selecting submissions and files by group, user, name and mime type
+        :param dry_run: only print how many files and bytes would be downloaded
+        :param order: smallest_first, or assignments_first: in the order of assignment_ids, small files first in each
+        :param rate: bytes per second all downloads together may use, 0 for no limit
+        :param max_file_size: files larger than that many bytes are not downloaded, 0 for no limit
+        """
+        assignments = self.selected_assignments(self.worktree.data, assignment_ids)
+        downloads = self.worktree.downloads
+        changed, include, include_file = self._pull_selection(downloads, all_submissions, pull_filter)
+        planned = self.plan_downloads(assignments, downloads, include, include_file)
+        self._print_left_out(assignments, changed)
+
+        incomplete = set()  # assignments, whose watermark can't move, as files were left out.
+        if include_file is not None:
+            incomplete.update(a.id for a in assignments)
+        planned = self._limit_file_size(planned, max_file_size, incomplete)
+        self.order_downloads(planned, order, assignment_ids)
+
+        if dry_run:
+            unknown = sum(1 for p in planned if p.size is None or p.size < 0)
+            line = f'would download {len(planned):d} files, {format_size(sum(p.known_size for p in planned))}'
+            if unknown > 0:
+                line += f', {unknown:d} of unknown size, run sync -f to find out'
+            print(line)
+            return
+
+        incomplete.update(self.download_planned(planned, downloads, rate, max_file_size))
+        self._finish_pull(assignments, downloads, incomplete)
+
+    def sync_and_download_files(self, assignment_ids=None, all_submissions=False, rate=0, max_file_size=0,
+                                pull_filter=None):
+        """
+        sync and pull in one pipeline: submissions are requested per assignment, and the files of each
+        assignment are downloaded as soon as its submissions arrive, while the others are still requested.
+        Assignments, users and grades are synced first, planning needs them.
+        """
+        now = math.floor(datetime.now().timestamp())
+        print('syncing assignments, users and grades… ', end='', flush=True)
+        self.sync_assignments()
+        with cf.ThreadPoolExecutor(max_workers=2) as tpe:
+            phases = [tpe.submit(self.sync_users), tpe.submit(self.sync_grades)]
+            for phase in phases:
+                phase.result()
+        print('finished.')
+
+        assignments = self.selected_assignments(self.worktree.data, assignment_ids)
+        downloads = self.worktree.downloads
+        changed, include, include_file = self._pull_selection(downloads, all_submissions, pull_filter)
+        known_files = self.worktree.file_meta.index()
+        incomplete = set()
+        if include_file is not None:
+            incomplete.update(a.id for a in assignments)
+        by_id = {a.id: a for a in assignments}
+        since = self.worktree.submissions.last_sync
+        skipped = 0
+
+        # a few threads of their own for the submissions, so downloads start while they are requested.
+        with cf.ThreadPoolExecutor(max_workers=self.max_workers) as tpe, \
+                cf.ThreadPoolExecutor(max_workers=min(4, self.max_workers)) as metadata:
+            run = DownloadRun(self, tpe, downloads, rate, max_file_size)
+            try:
+                requested = {metadata.submit(self.session.mod_assign_get_submissions, [as_id], since=since): as_id
+                             for as_id in by_id}
+                while len(requested) + len(run.futures) > 0:
+                    done, _ = cf.wait(set(requested) | set(run.futures), timeout=0.5,
+                                      return_when=cf.FIRST_COMPLETED)
+                    for future in done:
+                        if future not in requested:
+                            run.finish(future)
+                            continue
+                        assignment = by_id[requested.pop(future)]
+                        self.worktree.submissions.merge(future.result())
+                        assignment.submissions = self.worktree.submissions.get(assignment.id, None)
+                        files = self.worktree.prepare_download([assignment], include, create_folders=False)
+                        if include_file is not None:
+                            files = [f for f in files if include_file(f)]
+                        planned, unchanged = self._plan_files(files, downloads, known_files)
+                        skipped += unchanged
+                        planned = self._limit_file_size(planned, max_file_size, incomplete, quiet=True)
+                        self.order_downloads(planned, smallest_first)
+                        run.add(planned)
+                    run.print_progress()
+                if not assignment_ids:  # only when every assignment was asked for.
+                    self.worktree.submissions.mark_synced(now)
+            except KeyboardInterrupt:
+                print('stopping…')
+                metadata.shutdown()
+                tpe.shutdown()
+                raise
+            finally:
+                downloads.write()
+        print(f'\nreceived {format_size(run.meter.received)} in {format_duration(run.meter.elapsed)}')
+        if skipped > 0:
+            print(f'{skipped:d} files are unchanged since the last pull, not downloading them again')
+        self._print_left_out(assignments, changed)
+        incomplete.update(run.report_failures())
+        self._finish_pull(assignments, downloads, incomplete)
+
+    @staticmethod
+    def selected_assignments(courses, assignment_ids=None):
         assignments = []
         if assignment_ids is None or 0 == len(assignment_ids):
             for c in courses:
@@ -119,65 +442,426 @@ class MoodleFrontend:
         else:
             for c in courses:
                 assignments += c.get_assignments(assignment_ids)
-
-        files = self.worktree.prepare_download(assignments)
-
-        file_count = len(files)
-        counter = 0
-        # todo, error handling
-        if file_count > 0:
-            interaction.print_progress(counter, file_count)
-            with cf.ThreadPoolExecutor(max_workers=MAX_WORKERS) as tpe:
-                try:
-                    future_to_file = {tpe.submit(self.session.download_file, file.url): file for file in files}
-                    for future in cf.as_completed(future_to_file):
-                        file = future_to_file[future]
-                        response = future.result()
-                        counter += 1
-                        interaction.print_progress(counter, file_count, suffix=file.path)
-                        self.worktree.write_submission_file(file, response.content)
-                except KeyboardInterrupt:
-                    print('stopping…')
-                    tpe.shutdown()
-                    raise
+        return assignments
+
+    def _pull_selection(self, downloads, all_submissions, pull_filter):
+        """:returns the changed_or_ungraded predicate, if used, and the submission and file predicates"""
+        changed = None if all_submissions else self.changed_or_ungraded(downloads)
+        include, include_file = changed, None
+        if pull_filter is not None and pull_filter.is_active:
+            include = pull_filter.includes_submission if changed is None else \
+                (lambda s: changed(s) and pull_filter.includes_submission(s))
+            include_file = pull_filter.includes_file
+        return changed, include, include_file
+
+    @staticmethod
+    def _print_left_out(assignments, changed):
+        if changed is None:
+            return
+        left_out = sum(1 for a in assignments for s in a.submissions.values() if not changed(s))
+        if left_out > 0:
+            print(f'{left_out:d} graded submissions are unchanged since the last pull, use --all to pull them')
+
+    @staticmethod
+    def _limit_file_size(planned, max_file_size, incomplete, quiet=False):
+        """drops files known to be larger than max_file_size, their assignments are added to incomplete"""
+        if max_file_size <= 0:
+            return planned
+        too_large = [p for p in planned if p.known_size > max_file_size]
+        if len(too_large) > 0:
+            if not quiet:
+                print(f'{len(too_large):d} files are larger than {format_size(max_file_size)}, not downloading them')
+            incomplete.update(p.assignment_id for p in too_large)
+        return [p for p in planned if p.known_size <= max_file_size]
+
+    @staticmethod
+    def order_downloads(planned, order, assignment_ids=None):
+        planned.sort(key=lambda p: p.size if p.size is not None and p.size >= 0 else math.inf)
+        if order == assignments_first and assignment_ids:
+            position = {as_id: n for n, as_id in enumerate(assignment_ids)}
+            planned.sort(key=lambda p: position.get(p.assignment_id, len(position)))  # stable, keeps sizes sorted.
+
+    def _finish_pull(self, assignments, downloads, incomplete):
+        """moves the watermarks of completely pulled assignments and writes their grading files"""
+        for a in assignments:
+            if a.id not in incomplete and len(a.submissions) > 0:
+                downloads.set_pulled_until(a.id, max(s.time_modified for s in a.submissions.values()))
+        downloads.write()
 
         for a in assignments:
             self.worktree.write_grading_and_html_file(a)
 
-    def upload_grades(self, upload_data):
-        def argument_list(upload_data):
-            for grades in upload_data:
-                as_id = grades.assignment_id
-                team = grades.team_submission
-                args = []
-                for values in grades.grades:
-                    args.append({
-                        'assignment_id': as_id,
-                        'user_id': values.id,
-                        'grade': values.grade,
-                        'feedback_text': values.feedback,
-                        'team_submission': team
-                    })
-                return args
-
-        args_list = argument_list(upload_data)
-        grade_count = len(args_list)
+    @staticmethod
+    def changed_or_ungraded(downloads):
+        """
+        pull's default selection of submissions: ungraded ones, and those modified after the watermark of their
+        assignment, the newest submission the last complete pull saw.
+        """
+        def include(submission):
+            if submission.time_modified > downloads.pulled_until(submission.assignment.id):
+                return True
+            return not submission.is_graded
+        return include
+
+    def plan_downloads(self, assignments, downloads, include=None, include_file=None):
+        """
+        The submission files of assignments, that are not downloaded yet or changed since,
+        with what is known about them from the submissions and sync -f.
+
+        :param downloads: the DownloadIndex of the work tree
+        :param include: optional predicate, only submissions it accepts are planned
+        :param include_file: optional predicate, only files it accepts are planned
+        """
+        files = self.worktree.prepare_download(assignments, include, create_folders=False)
+        if include_file is not None:
+            files = [f for f in files if include_file(f)]
+        planned, skipped = self._plan_files(files, downloads, self.worktree.file_meta.index())
+        if skipped > 0:
+            print(f'{skipped:d} files are unchanged since the last pull, not downloading them again')
+        return planned
+
+    def _plan_files(self, files, downloads, known_files):
+        """:returns the PlannedDownloads of files, and how many files were skipped, as they are current"""
+        planned = []
+        skipped = 0
+        for file in files:
+            params = file.meta_data_params
+            key = file_meta_key(params['context_id'], params['component'], params['file_area'],
+                                params['item_id'], file.file_path, file.name)
+            size, time_modified, content_hash = file.get(Jn.file_size, None), file.get(Jn.time_modified, None), None
+            meta = known_files.get(key)
+            if meta is not None:  # from sync -f, fills in what older moodle versions leave out of submissions.
+                content_hash = meta.content_hash
+                size = meta.file_size if size is None else size
+                time_modified = meta.time_modified if time_modified is None else time_modified
+            if downloads.is_current(key, size, time_modified, content_hash) and \
+                    self.worktree.submission_file_exists(file):
+                skipped += 1
+                continue
+            planned.append(PlannedDownload(file, key, size, time_modified, content_hash))
+        return planned, skipped
+
+    def download_planned(self, planned, downloads, rate=0, max_file_size=0):
+        """
+        Downloads in the order of planned, files are started as workers become free.
+        The progress line shows the throughput and time left, refreshed while downloads run.
+
+        :returns the ids of assignments with failed downloads
+        """
+        if len(planned) == 0:
+            return set()
+        with cf.ThreadPoolExecutor(max_workers=self.max_workers) as tpe:
+            run = DownloadRun(self, tpe, downloads, rate, max_file_size)
+            try:
+                run.add(planned)
+                run.print_progress()
+                while len(run.futures) > 0:
+                    done, _ = cf.wait(set(run.futures), timeout=0.5, return_when=cf.FIRST_COMPLETED)
+                    for future in done:
+                        run.finish(future)
+                    run.print_progress()
+            except KeyboardInterrupt:
+                print('stopping…')
+                tpe.shutdown()
+                raise
+            finally:
+                downloads.write()
+        print(f'received {format_size(run.meter.received)} in {format_duration(run.meter.elapsed)}')
+        return run.report_failures()
+
+    def _download_verified(self, file, size=None, content_hash=None, attempts=3, **kwargs):
+        """
+        Downloads file to its partial_download_path and checks it against the contenthash, if known,
+        else against the size. Mismatches, like truncated transfers, are downloaded again.
+
+        :param kwargs: for MoodleSession.download_file_to
+        :raises DownloadFailed: if no attempt matched, the partial file is removed then
+        :returns size and sha1 of the download
+        """
+        import requests
+        part = self.worktree.partial_download_path(file)
+        reason = ''
+        for attempt in range(attempts):
+            try:
+                received_size, sha1 = self.session.download_file_to(file.url, part, **kwargs)
+            except requests.RequestException as e:
+                reason = str(e)
+                continue
+            except FileTooLarge as e:
+                reason = str(e)
+                break
+            if content_hash is not None and sha1 != content_hash:
+                reason = f'sha1 {sha1} does not match contenthash {content_hash}'
+            elif content_hash is None and size is not None and size >= 0 and received_size != size:
+                reason = f'received {received_size:d} bytes, expected {size:d}'
+            else:
+                return received_size, sha1
+        try:
+            part.unlink()
+        except OSError:
+            pass
+        raise DownloadFailed(file.path, reason)
+
+    def grade_upload_function(self):
+        """mod_assign_save_grades if the service offers it, else mod_assign_save_grade, or FunctionNotAvailable"""
+        if self.has_function('mod_assign_save_grades'):
+            return 'mod_assign_save_grades'
+        functions = self.available_functions
+        if functions is not None and 'mod_assign_save_grade' not in functions:
+            raise FunctionNotAvailable(['mod_assign_save_grades or mod_assign_save_grade'])
+        return 'mod_assign_save_grade'
+
+    # grades per mod_assign_save_grades call, a dropped connection loses no more than that many.
+    grades_per_request = 100
+
+    def check_grade_conflicts(self, entries, journal):
+        """
+        Asks moodle for the grades of the affected assignments changed since the last sync, in one call.
+        An entry conflicts, if its grade was changed after the grade it is based on, by someone else and to another
+        value. Entries of grading files without timemodified are based on the last sync, so the answer is not merged,
+        that would make the changes of others the base. Changes synced after the grading file was written are
+        found in the synced grades.
+
+        :returns the conflicting entries, with moodle's grade and its time
+        """
+        functions = self.available_functions
+        if functions is not None and 'mod_assign_get_grades' not in functions:
+            print('can\'t check, if someone else changed the grades: mod_assign_get_grades is not available')
+            return []
+
+        synced = {}
+        for as_id in {e['assignment_id'] for e in entries}:
+            for grade in models.MoodleGradeList(self.worktree.grades.get(as_id, [])):
+                synced[(as_id, grade.user_id)] = Grade(grade.raw)
+        response = self.session.mod_assign_get_grades(sorted({e['assignment_id'] for e in entries}),
+                                                      since=self.worktree.grades.last_sync)
+        changed = {}
+        for assignment in models.AssignmentGradeResponse(response).assignments:
+            for grade in assignment.grades:
+                changed[(assignment.id, grade.user_id)] = Grade(grade.raw)
+
+        def same(a, b):
+            return a is not None and b is not None and round(float(a), 5) == round(float(b), 5)
+
+        conflicts = []
+        for entry in entries:
+            key = (entry['assignment_id'], entry['user_id'])
+            base_time = entry.get('base_time')
+            grade = changed.get(key)
+            if grade is None and base_time is not None:
+                grade = synced.get(key)
+            if grade is None:
+                continue
+            if base_time is None:
+                base_time = synced[key].time_modified if key in synced else 0
+            if grade.time_modified <= base_time or same(grade.value, entry['grade']):
+                continue
+            confirmed = journal.last_confirmed(*key)
+            if confirmed is not None and same(grade.value, confirmed['grade']):
+                continue  # our own, earlier upload.
+            entry['moodle_grade'] = grade.value
+            entry['moodle_time'] = grade.time_modified
+            conflicts.append(entry)
+        return conflicts
+
+    @staticmethod
+    def print_grade_conflicts(conflicts):
+        print(f'{len(conflicts):d} grades were changed on moodle after the grade they are based on, '
+              f'not uploading them, --force overwrites them:')
+        for e in conflicts:
+            moodle_grade = '-' if e['moodle_grade'] is None else f'{e["moodle_grade"]:.1f}'
+            print(f'  {e["name"][:20]:>20}:{e["user_id"]:6d} {float(e["grade"]):5.1f}, moodle: {moodle_grade:>5} '
+                  f'since {datetime.fromtimestamp(e["moodle_time"]):%Y-%m-%d %H:%M}')
+
+    def diff_grades(self, entries, journal):
+        """
+        Compares the entries to what moodle has: the grade of the last sync, or the last confirmed upload, if that
+        is newer. mod_assign_get_grades has no feedback, it is compared to the last confirmed upload only,
+        feedback never uploaded counts as changed, unless it is empty.
+        Ungraded users with 0.0 and no feedback, as pull writes them into grading files, are unchanged.
+
+        :returns the changed entries, each with 'changes': 'new', or 'grade' and/or 'feedback'
+        """
+        synced = {}
+        changed = []
+        for entry in entries:
+            as_id = entry['assignment_id']
+            if as_id not in synced:
+                grades = models.MoodleGradeList(self.worktree.grades.get(as_id, []))
+                synced[as_id] = {g.user_id: Grade(g.raw) for g in grades}
+            grade = synced[as_id].get(entry['user_id'])
+            confirmed = journal.last_confirmed(as_id, entry['user_id'])
+
+            if confirmed is not None and (grade is None or confirmed['time'] >= grade.time_modified):
+                base_grade = confirmed['grade']
+            else:
+                base_grade = None if grade is None else grade.value
+            base_feedback = '' if confirmed is None else confirmed['feedback']
+
+            if base_grade is None and confirmed is None:
+                placeholder = round(float(entry['grade']), 5) == 0 and entry['feedback'] == ''
+                entry['changes'] = [] if placeholder else ['new']
+            else:
+                entry['changes'] = []
+                if base_grade is None or round(float(entry['grade']), 5) != round(float(base_grade), 5):
+                    entry['changes'].append('grade')
+                    entry['base_grade'] = base_grade
+                if entry['feedback'] != base_feedback:
+                    entry['changes'].append('feedback')
+            if len(entry['changes']) > 0:
+                changed.append(entry)
+        return changed
+
+    @staticmethod
+    def print_grade_changes(changed, unchanged_count):
+        grade_format = '  {:>20}:{:6d} {:>5} > {:5.1f} {}'
+        by_assignment = {}
+        for entry in changed:
+            by_assignment.setdefault(entry['assignment_id'], []).append(entry)
+        for as_id, entries in by_assignment.items():
+            new = sum(1 for e in entries if 'new' in e['changes'])
+            print(f' assignment {as_id:5d}: {len(entries) - new:d} changed, {new:d} new')
+            for e in entries:
+                base = e.get('base_grade')
+                base = '' if 'grade' not in e['changes'] else '-' if base is None else f'{float(base):.1f}'
+                feedback = '' if 'feedback' not in e['changes'] and 'new' not in e['changes'] else e['feedback'][:40]
+                print(grade_format.format(e['name'][:20], e['user_id'], base, float(e['grade']), feedback))
+        print(f'{len(changed):d} grades to upload, {unchanged_count:d} unchanged')
+
+    @staticmethod
+    def confirm_upload():
+        answer = input('does this look good? [Y/n]: ')
+
+        if 'n' == answer:
+            print('do it right, then')
+            raise SystemExit(0)
+        elif not ('y' == answer.lower() or '' == answer):
+            print('wat')
+            raise SystemExit(1)
+
+    def upload_grades(self, entries, resume=False, all_grades=False, force=False):
+        """
+        uploads the grades of parse_grade_files' plan, that differ from moodle's, after asking.
+        Every grade is recorded in the grade journal.
+
+        :param resume: continue the journal of the last upload, grades it confirmed with the same values are skipped
+        :param all_grades: upload unchanged grades too
+        :param force: upload grades someone else changed on moodle since, instead of leaving them out
+        """
+        journal = self.worktree.grade_journal
+        conflicts = [] if force else self.check_grade_conflicts(entries, journal)
+        if len(conflicts) > 0:
+            conflicting = {id(e) for e in conflicts}
+            entries = [e for e in entries if id(e) not in conflicting]
+
+        if all_grades:
+            for entry in entries:
+                entry['changes'] = ['grade', 'feedback']
+            upload = entries
+        else:
+            upload = self.diff_grades(entries, journal)
+        if resume:
+            upload = [e for e in upload if not journal.is_confirmed(e)]
+
+        print('this will upload the following grades:')
+        self.print_grade_changes(upload, len(entries) - len(upload))
+        if len(conflicts) > 0:
+            self.print_grade_conflicts(conflicts)
+        if len(upload) == 0:
+            return
+        self.confirm_upload()
+
+        if resume:
+            journal.add(upload)
+        else:
+            unfinished = journal.unfinished()
+            if len(unfinished) > 0:
+                print(f'the last upload did not finish, {len(unfinished):d} of its grades were not confirmed, '
+                      f'starting over with these grading files')
+            journal.start(upload)
+        self.upload_grade_entries(upload, journal)
+
+    def resume_grade_upload(self):
+        """uploads the grades of the journal, that were not confirmed"""
+        journal = self.worktree.grade_journal
+        entries = journal.unfinished()
+        if len(entries) > 0:
+            print(f'resuming upload: {len(entries):d} of {len(journal):d} grades are not confirmed')
+        self.upload_grade_entries(entries, journal)
+
+    def upload_grade_entries(self, entries, journal):
+        """
+        sends the grades, one call per grade, or with mod_assign_save_grades per assignment in batches.
+        Grades are marked sent before and confirmed after their call, failed calls are reported, not retried.
+        """
+        import requests
+
+        if len(entries) == 0:
+            print('nothing to upload')
+            return
+
+        if self.grade_upload_function() == 'mod_assign_save_grades':
+            calls = self._bulk_grade_calls(entries)
+        else:
+            calls = [([e], self.session.mod_assign_save_grade, {
+                'assignment_id': e['assignment_id'],
+                'user_id': e['user_id'],
+                'grade': e['grade'],
+                'feedback_text': e['feedback'],
+                'team_submission': e['team_submission'],
+            }) for e in entries]
+
+        grade_count = len(entries)
         counter = 0
+        failed = []
+        interaction.print_progress(counter, grade_count)
+        with cf.ThreadPoolExecutor(max_workers=self.max_workers) as tpe:
+            try:
+                future_to_batch = {
+                    tpe.submit(self._send_grades, journal, batch, function, kwargs): batch
+                    for batch, function, kwargs in calls
+                }
+                for future in cf.as_completed(future_to_batch):
+                    batch = future_to_batch[future]
+                    try:
+                        future.result()
+                    except (MoodleException, requests.RequestException) as e:
+                        failed.append((batch, e))
+                    counter += len(batch)
+                    interaction.print_progress(counter, grade_count)
+            except KeyboardInterrupt:
+                print('stopping…')
+                tpe.shutdown()
+                raise
+
+        if len(failed) > 0:
+            for batch, error in failed:
+                users = ', '.join(str(e['user_id']) for e in batch)
+                print(f'assignment {batch[0]["assignment_id"]:d}, users {users}: {error}')
+            print(f'{sum(len(batch) for batch, _ in failed):d} grades were not uploaded, '
+                  f'mdt grade --resume uploads them')
+            raise SystemExit(1)
 
-        if grade_count > 0:
-            interaction.print_progress(counter, grade_count)
-            with cf.ThreadPoolExecutor(max_workers=MAX_WORKERS) as tpe:
-                try:
-                    future_to_grade = {tpe.submit(self.session.mod_assign_save_grade, **args): args for args in args_list}
-                    for future in cf.as_completed(future_to_grade):
-                        args = future_to_grade[future]
-                        response = future.result()
-                        counter += 1
-                        interaction.print_progress(counter, grade_count)
-                except KeyboardInterrupt:
-                    print('stopping…')
-                    tpe.shutdown()
-                    raise
+    def _bulk_grade_calls(self, entries):
+        """mod_assign_save_grades calls of up to grades_per_request grades, per assignment"""
+        by_assignment = {}
+        for e in entries:
+            by_assignment.setdefault((e['assignment_id'], e['team_submission']), []).append(e)
+        calls = []
+        for (as_id, team), assignment_entries in by_assignment.items():
+            for start in range(0, len(assignment_entries), self.grades_per_request):
+                batch = assignment_entries[start:start + self.grades_per_request]
+                grades = [{'user_id': e['user_id'], 'grade': e['grade'], 'feedback_text': e['feedback']} for e in batch]
+                calls.append((batch, self.session.mod_assign_save_grades,
+                              {'assignment_id': as_id, 'grades': grades, 'apply_to_all': team}))
+        return calls
+
+    @staticmethod
+    def _send_grades(journal, batch, function, kwargs):
+        keys = [e['key'] for e in batch]
+        journal.mark(keys, journal.sent)
+        function(**kwargs)
+        journal.mark(keys, journal.confirmed)
 
     def upload_files(self, files):
         # TODO, Wrap and return it, don't print. do print in wstools.upload. also modify submit
@@ -209,84 +893,82 @@ class MoodleFrontend:
         # TODO: wrap and return to wstools.auth
         from moodle.communication import MoodleSession
 
-        session = MoodleSession(moodle_url=url)
+        session = MoodleSession(moodle_url=url, **session_options)
         token = session.get_token(user_name=user, password=password, service=service)
 
         return token
 
     def get_user_id(self):
         # TODO: wrap and return to wstools.auth
-        from moodle.fieldnames import JsonFieldNames as Jn
         data = self.session.core_webservice_get_site_info()
         return data[Jn.user_id]
 
     def parse_grade_files(self, fd_list):
         """
-        this mostly rewrites the values read from the grading file.
-        since most of this can be done, when creating the grading file
-        it should be done there.
-        Namely, adding a team_submission field and instead of
-        setting the submission.id in the file, use the user.id instead
-
-        :param fd_list:
-        :return:
-        """
-
-        upload_data = []
-
-        print('this will upload the following grades:')
-        grade_format = '  {:>20}:{:6d} {:5.1f} > {}'
-
-        invalid_values = []
-
-        for file in fd_list:
-            # cls needs to be set, for the strict flag to be registered.
-            wrapped = GradingFile(json.load(file, cls=json.JSONDecoder, strict=False))
+        Decodes the grading files concurrently and checks them together, against one index of the work tree.
+        Grades above the max points, unknown assignments, submissions and groups and users graded twice
+        are all reported, before exiting.
 
-            assignment = Assignment(self.worktree.assignments[wrapped.assignment_id])
-            assignment.course = Course(self.worktree.courses[assignment.course_id])
-
-            assignment.course.users = self.worktree.users[str(assignment.course_id)]
-            assignment.submissions = self.worktree.submissions[assignment.id]
+        :returns the upload plan, one dict per grade: assignment_id, user_id, name, grade, feedback,
+            team_submission and base_time, the timemodified of the grade it is based on, if the file has it
+        """
 
-            wrapped.team_submission = assignment.is_team_submission
+        def decode(file):
+            # grading files are written by hand, so allow raw new lines in feedback.
+            try:
+                return GradingFile(serialization.load(file, strict=False))
+            except serialization.DecodeError as e:
+                return f'{file.name}: not valid json, {e}'
 
-            print(f' assignment {assignment.id:5d}, team_submission: {assignment.is_team_submission}')
+        with cf.ThreadPoolExecutor(max_workers=self.max_workers) as tpe:
+            decoded = list(tpe.map(decode, fd_list))
 
-            for grade in wrapped.grades:
-                submission = assignment.submissions[grade.id]
-
-                if assignment.is_team_submission:
-                    group = assignment.course.groups[submission.group_id]
-                    user = group.members[0]
-                    grade.id = user.id
-                else:
-                    grade.id = submission.user_id
+        errors = [d for d in decoded if isinstance(d, str)]
+        files = [(file.name, d) for file, d in zip(fd_list, decoded) if not isinstance(d, str)]
+        index = GradingIndex(self.worktree, {grading_file.assignment_id for _, grading_file in files})
 
+        grade_format = '  {:>20}:{:6d} {:5.1f} > {}'
+        entries = []
+        graded = {}  # (assignment id, user id): name of the file
+        for name, grading_file in files:
+            as_id = grading_file.assignment_id
+            assignment = index.assignments.get(as_id)
+            if assignment is None:
+                errors.append(f'{name}: unknown assignment {as_id}, sync first?')
+                continue
+            recipients = index.recipients[as_id]
+            for grade in grading_file.grades:
+                if grade.id not in recipients:
+                    errors.append(f'{name}: assignment {as_id:d} has no submission {grade.id}, {grade.name}')
+                    continue
+                user_id = recipients[grade.id]
+                if user_id is None:
+                    errors.append(f'{name}: the group of {grade.name} is unknown, sync users?')
+                    continue
                 if assignment.max_points < grade.grade:
-                    invalid_values.append(grade)
-
-                print(grade_format.format(grade.name, grade.id, grade.grade, grade.feedback[:40]))
-
-            upload_data.append(wrapped)
-
-        if len(invalid_values) > 0:
-            for grade in invalid_values:
-                print(
-                    "WARNING: the grade value is larger than the max achievable grade")
-                print(grade_format.format(grade.name, grade.id, grade.grade, grade.feedback[:40]))
-            raise SystemExit(1)
-
-        answer = input('does this look good? [Y/n]: ')
-
-        if 'n' == answer:
-            print('do it right, then')
-            raise SystemExit(0)
-        elif not ('y' == answer.lower() or '' == answer):
-            print('wat')
+                    errors.append(f'{name}: the grade value is larger than the max achievable grade '
+                                  f'{assignment.max_points}\n' +
+                                  grade_format.format(grade.name, user_id, grade.grade, grade.feedback[:40]))
+                if (as_id, user_id) in graded:
+                    errors.append(f'{name}: {grade.name} is graded twice for assignment {as_id:d}, '
+                                  f'see {graded[(as_id, user_id)]}')
+                graded[(as_id, user_id)] = name
+                entries.append({
+                    'assignment_id': as_id,
+                    'user_id': user_id,
+                    'name': grade.name,
+                    'grade': grade.grade,
+                    'feedback': grade.feedback,
+                    'team_submission': assignment.is_team_submission,
+                    'base_time': grade.time_modified,
+                })
+
+        if len(errors) > 0:
+            for error in errors:
+                print('ERROR: ' + error)
             raise SystemExit(1)
 
-        return upload_data
+        return entries
 
     def get_course_content(self):
         for course_id in self.course_ids:
@@ -329,6 +1011,6 @@ class MoodleFrontend:
 
                     if module.modname not in known_dumpable+uncertain+known_undumpable+unchecked:
                         print(module.modname)
-                        #print(json.dumps(module.raw, indent=2, ensure_ascii=False))
+                        #print(serialization.dumps(module.raw))
                     if module.modname == 'organizer':
-                        print(json.dumps(module.raw, indent=2, ensure_ascii=False))
+                        print(serialization.dumps(module.raw))
@@ -0,0 +1,227 @@
+import concurrent.futures as cf
+import sys
+import time
+from datetime import datetime
+
+import requests
+
+import moodle.models as models
+from frontend.models import Grade
+from moodle.exceptions import MoodleException
+from util.transfer import smallest_first
+
+
+class WatchedAssignment:
+    """
+    Poll state of one assignment: the submissions and grades seen so far, the per assignment `since`
+    for the next requests and when to ask next.
+    """
+    # assignments this close to their due date are always polled at the shortest interval.
+    deadline_window = 2 * 3600
+
+    def __init__(self, assignment, submissions, grades, interval):
+        self.assignment = assignment
+        self.submissions = {s.id: s.time_modified for s in models.MoodleSubmissionList(submissions)}
+        self.grades = {g.user_id: (g.grade, g.time_modified) for g in models.MoodleGradeList(grades)}
+        self.interval = interval
+        self.next_poll = 0.0
+
+    @property
+    def id(self):
+        return self.assignment.id
+
+    @property
+    def submissions_since(self):
+        """moodle's clock, not ours: the newest submission seen, it is sent again and recognized as known"""
+        return max(self.submissions.values(), default=0)
+
+    @property
+    def grades_since(self):
+        return max((modified for grade, modified in self.grades.values()), default=0)
+
+    def near_deadline(self, now):
+        return abs(self.assignment.due_date.timestamp() - now) < self.deadline_window
+
+    def reschedule(self, now, changed, min_interval, max_interval):
+        """back to min_interval after changes or close to the deadline, else twice as long as before"""
+        if changed or self.near_deadline(now):
+            self.interval = min_interval
+        else:
+            self.interval = min(self.interval * 2, max_interval)
+        self.next_poll = now + self.interval
+
+    def back_off(self, now, max_interval):
+        """after a failed poll, twice as long as before, even close to the deadline"""
+        self.interval = min(self.interval * 2, max_interval)
+        self.next_poll = now + self.interval
+
+
+# what a poll can fail with, without stopping watch. The session exits on responses that are not json,
+# like the error pages of a proxy.
+poll_errors = (requests.RequestException, MoodleException, SystemExit)
+
+
+def error_text(error):
+    if isinstance(error, SystemExit):
+        return 'moodle sent an unexpected response'
+    return f'{type(error).__name__}: {error}'
+
+
+class Watcher:
+    """
+    Keeps one session and the work tree in memory, and polls the submissions and grades of the watched
+    assignments, each at its own, adaptive interval. Changes are merged into .mdt, new files downloaded
+    and every new submission and grade change is written as one line to the event log.
+    """
+
+    def __init__(self, frontend, assignment_ids=None, min_interval=30, max_interval=600, download=True,
+                 out=sys.stdout, log_file=None):
+        self.frontend = frontend
+        self.worktree = frontend.worktree
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.download = download
+        self.out = out
+        self.log_file = log_file
+        self.courses = self.worktree.data
+        self.all_assignments = not assignment_ids
+        self.watched = []
+        for assignment in frontend.selected_assignments(self.courses, assignment_ids):
+            self.watched.append(WatchedAssignment(assignment, self.worktree.submissions.get(assignment.id, []),
+                                                  self.worktree.grades.get(assignment.id, []), min_interval))
+
+    def run(self, polls=None):
+        """polls until interrupted, or polls times"""
+        count = 0
+        self.event('watching', f'{len(self.watched):d} assignments')
+        if len(self.watched) == 0:
+            return
+        while polls is None or count < polls:
+            now = time.time()
+            due = [w for w in self.watched if w.next_poll <= now]
+            if len(due) == 0:
+                time.sleep(max(min(w.next_poll for w in self.watched) - now, 0.1))
+                continue
+            self.poll(due)
+            count += 1
+
+    def poll(self, due):
+        now = time.time()
+        session = self.frontend.session
+        with cf.ThreadPoolExecutor(max_workers=self.frontend.max_workers) as tpe:
+            future_to_watched = {}
+            for w in due:
+                submissions = tpe.submit(session.mod_assign_get_submissions, [w.id], since=w.submissions_since)
+                grades = tpe.submit(session.mod_assign_get_grades, [w.id], since=w.grades_since)
+                future_to_watched[w] = (submissions, grades)
+
+        changed_submissions = []
+        for w, (submissions, grades) in future_to_watched.items():
+            try:
+                submissions, grades = submissions.result(), grades.result()
+            except poll_errors as e:
+                self.event('error', f'{w.id:d} {error_text(e)}')
+                w.back_off(now, self.max_interval)
+                continue
+            new_submissions = self._apply_submissions(w, submissions)
+            new_grades = self._apply_grades(w, grades)
+            if new_submissions or new_grades:
+                # rebuilt, so is_graded and the file lists see the merged data.
+                w.assignment.grades = self.worktree.grades.get(w.id, None)
+                w.assignment.submissions = self.worktree.submissions.get(w.id, None)
+            if new_submissions:
+                changed_submissions.append(w.assignment)
+            w.reschedule(now, new_submissions or new_grades, self.min_interval, self.max_interval)
+
+        if self.all_assignments:
+            self._mark_synced()
+
+        if self.download and len(changed_submissions) > 0:
+            try:
+                self._download(changed_submissions)
+            except poll_errors as e:
+                self.event('error', f'downloading: {error_text(e)}')
+
+    def _mark_synced(self):
+        """every assignment was asked for all changes since its own `since`, the oldest of them is safe for sync"""
+        submissions_since = min(w.submissions_since for w in self.watched)
+        if submissions_since > self.worktree.submissions.last_sync:
+            self.worktree.submissions.mark_synced(submissions_since)
+        grades_since = min(w.grades_since for w in self.watched)
+        if grades_since > self.worktree.grades.last_sync:
+            self.worktree.grades.mark_synced(grades_since)
+
+    def _apply_submissions(self, watched, response):
+        """merges the response, logs new and updated submissions, :returns if there were any"""
+        changes = []
+        for assignment in models.AssignmentSubmissionResponse(response).assignments:
+            for submission in assignment.submissions:
+                known = watched.submissions.get(submission.id)
+                if known is not None and known >= submission.time_modified:
+                    continue
+                changes.append(('submitted' if known is None else 'resubmitted', submission))
+                watched.submissions[submission.id] = submission.time_modified
+        if len(changes) == 0:
+            return False
+        self.worktree.submissions.merge(response)
+        for kind, submission in changes:
+            self.event(kind, f'{watched.id:d} {self._submitter(watched.assignment, submission)} '
+                             f'status:{submission.status}')
+        return True
+
+    def _apply_grades(self, watched, response):
+        """
+        merges the response, logs new and changed grades, :returns if there were any.
+        Grades modified without a new value, like when only the feedback was edited, are logged as updated.
+        """
+        changes = []
+        for assignment in models.AssignmentGradeResponse(response).assignments:
+            for grade in assignment.grades:
+                known = watched.grades.get(grade.user_id)
+                if known is None:
+                    kind = 'graded'
+                elif known[0] != grade.grade:
+                    kind = 'regraded'
+                elif known[1] < grade.time_modified:
+                    kind = 'updated'
+                else:
+                    continue
+                changes.append((kind, grade))
+                watched.grades[grade.user_id] = (grade.grade, grade.time_modified)
+        if len(changes) == 0:
+            return False
+        self.worktree.grades.merge(response)
+        users = watched.assignment.course.users
+        for kind, grade in changes:
+            user = users.get(grade.user_id)
+            name = user.name if user is not None else str(grade.user_id)
+            value = Grade(grade.raw).value
+            self.event(kind, f'{watched.id:d} {name} grade:{"-" if value is None else value}')
+        return True
+
+    @staticmethod
+    def _submitter(assignment, submission):
+        course = assignment.course
+        if assignment.is_team_submission:
+            group = course.groups.get(submission.group_id)
+            return group.name if group is not None else f'group {submission.group_id:d}'
+        user = course.users.get(submission.user_id)
+        return user.name if user is not None else f'user {submission.user_id:d}'
+
+    def _download(self, assignments):
+        frontend = self.frontend
+        downloads = self.worktree.downloads
+        planned = frontend.plan_downloads(assignments, downloads, frontend.changed_or_ungraded(downloads))
+        frontend.order_downloads(planned, smallest_first)
+        before = {p.key: downloads.get(p.key) for p in planned}
+        frontend.download_planned(planned, downloads, frontend.config.download_rate)
+        for p in planned:
+            if downloads.get(p.key) is not before[p.key]:  # recorded anew, so it was downloaded.
+                self.event('downloaded', f'{p.assignment_id:d} {p.file.path.relative_to(self.worktree.root)}')
+
+    def event(self, kind, text):
+        line = f'{datetime.now():%Y-%m-%d %H:%M:%S} {kind:11} {text}'
+        print(line, file=self.out, flush=True)
+        if self.log_file is not None:
+            with open(self.log_file, 'a') as log:
+                print(line, file=log)
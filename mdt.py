@@ -1,12 +1,33 @@
 #!/usr/bin/env python3
+import argparse
+import contextlib
 import glob
 import os
 import re
 import subprocess
 import sys
 
+from pathlib import Path
+
 from frontend import commands
-from persistence.worktree import NotInWorkTree
+from frontend.cmdparser import Argument
+from moodle.exceptions import FunctionNotAvailable
+from persistence.exceptions import NotInWorkTree
+
+global_arguments = [
+    Argument('--record', metavar='CASSETTE',
+             help='record all web service calls to CASSETTE, without tokens and personal data'),
+    Argument('--replay', metavar='CASSETTE', help='answer web service calls from CASSETTE, without network'),
+    Argument('--stats', action='store_true',
+             help='print per web service function call counts, latencies and payload sizes as json'),
+    Argument('--stats-file', metavar='FILE', help='like --stats, but write the json to FILE'),
+    Argument('--no-cache', action='store_true', help='ask moodle, even if a cached response is available'),
+    Argument('--profile', metavar='FILE',
+             help='run the command under cProfile, write pstats to FILE and print the slowest functions'),
+    Argument('--profile-wall', metavar='FILE',
+             help='sample the stacks of all threads, including downloads, and write folded stacks to FILE'),
+    Argument('--profile-top', metavar='N', type=int, default=20, help='functions shown in profile summaries'),
+]
 
 
 def exec_path_to_dict(paths):
@@ -21,26 +42,64 @@ def exec_path_to_dict(paths):
     return dict(zip(cmd_names, paths))
 
 
+def plugin_index_file():
+    try:
+        return Path(os.environ['XDG_CACHE_HOME']) / 'mdt' / 'plugins'
+    except KeyError:
+        return Path.home() / '.cache' / 'mdt' / 'plugins'
+
+
+def _exec_path_mtimes(exec_paths):
+    mtimes = {}
+    for path in exec_paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+
 def external_subcmds():
     """
     this gets all files that are in $PATH and match mdt-*
+    The result is kept in the plugin index, until $PATH or the modification time of one of its folders changes,
+    installing or removing a plugin changes the latter.
 
     :returns dict with subcmd:full_path
     """
 
+    from util import serialization
+
     exec_paths = os.get_exec_path()
+    mtimes = _exec_path_mtimes(exec_paths)
+    index_file = plugin_index_file()
+    try:
+        index = serialization.read_file(index_file)
+        if index['path'] == exec_paths and index['mtimes'] == mtimes:
+            return index['commands']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
     mdt_executable_paths = []
     for path in exec_paths:
         mdt_executable_paths += glob.glob(path + '/mdt-*')
-    return exec_path_to_dict(mdt_executable_paths)
+    commands = exec_path_to_dict(mdt_executable_paths)
+    try:
+        index_file.parent.mkdir(parents=True, exist_ok=True)
+        serialization.write_file(index_file, {'path': exec_paths, 'mtimes': mtimes, 'commands': commands},
+                                 compact_output=True)
+    except OSError:
+        pass  # an index is nice to have, a read only home is no reason to fail.
+    return commands
 
 
-def execute_external(sub_command):
+def execute_external(sub_command, argv, extern=None):
     """
     execute sub_command
     """
-    extern = external_subcmds()
-    argv = sys.argv[1:]
+    if extern is None:
+        extern = external_subcmds()
+    argv = list(argv)
     argv[0] = extern[sub_command]
     subprocess.run(argv)
 
@@ -49,11 +108,11 @@ def internal_cmd():
     return commands.pm.known_commands
 
 
-def check_for_sub_command():
-    if 1 >= len(sys.argv):
+def check_for_sub_command(argv):
+    if 0 == len(argv):
         return None
     else:
-        return sys.argv[1]
+        return argv[0]
 
 
 def print_known_external_commands():
@@ -61,29 +120,127 @@ def print_known_external_commands():
     [print('    ' + cmd) for cmd in sorted(external_subcmds().keys())]
 
 
+def print_help():
+    parser = commands.make_config_parser()
+    group = parser.add_argument_group('global options', 'can be given to every internal command')
+    for arg in global_arguments:
+        arg.add_to_parser(group)
+    parser.print_help()
+    print_known_external_commands()
+
+
+def parse_global_options(argv):
+    """
+    global options can be anywhere on the command line, they are removed before the sub command is parsed.
+
+    :returns the global options and the remaining argv
+    """
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    for arg in global_arguments:
+        arg.add_to_parser(parser)
+    return parser.parse_known_args(argv)
+
+
+@contextlib.contextmanager
+def global_options_applied(options):
+    from frontend import moodle
+
+    cassette = None
+    if options.record is not None or options.replay is not None:
+        from moodle.cassette import Cassette
+        if options.replay is not None:
+            cassette = Cassette(options.replay, Cassette.replay_mode)
+        else:
+            cassette = Cassette(options.record, Cassette.record_mode)
+        moodle.session_options['cassette'] = cassette
+
+    if options.no_cache:
+        moodle.session_options['cache_ttl'] = 0
+
+    stats = None
+    if options.stats or options.stats_file is not None:
+        from moodle.instrumentation import SessionStats
+        stats = SessionStats()
+        moodle.session_options['stats'] = stats
+    try:
+        with contextlib.ExitStack() as profilers:
+            if options.profile_wall is not None:
+                from util.profiling import sampled
+                profilers.enter_context(sampled(options.profile_wall, top=options.profile_top))
+            if options.profile is not None:
+                from util.profiling import profiled
+                profilers.enter_context(profiled(options.profile, top=options.profile_top))
+            yield
+    finally:
+        if cassette is not None:
+            cassette.close()
+        if stats is not None:
+            write_stats(stats, options.stats_file)
+
+
+def write_stats(stats, file_name):
+    if file_name is None:
+        stats.dump(sys.stdout)
+        return
+    with open(file_name, 'w') as file:
+        stats.dump(file)
+
+
+def run_on_server(options, sub_command, argv):
+    """
+    hands the command to the background server of the work tree, if one runs, see mdt serve.
+    Commands with global options always run here, they change the session of this process.
+
+    :returns the exit code of the server, or None if the command should run here
+    """
+    from util import server
+    if sub_command not in server.served_commands or 'MDT_NO_SERVER' in os.environ:
+        return None
+    if vars(options) != vars(parse_global_options([])[0]):
+        return None
+    return server.run_remote(argv)
+
+
+def run_external(sub_command, argv):
+    extern = external_subcmds()
+    if sub_command not in extern:
+        print_help()
+        raise SystemExit(1)
+    execute_external(sub_command, argv, extern)
+
+
 def main():
-    sub_command = check_for_sub_command()
+    sub_command = check_for_sub_command(sys.argv[1:])
+    if sub_command is not None and not sub_command.startswith('-') and sub_command not in internal_cmd():
+        # global options are for internal commands, external ones get their arguments unchanged.
+        run_external(sub_command, sys.argv[1:])
+        return
+
+    options, argv = parse_global_options(sys.argv[1:])
+    sub_command = check_for_sub_command(argv)
+
+    exit_code = run_on_server(options, sub_command, argv)
+    if exit_code is not None:
+        if exit_code != 0:
+            raise SystemExit(exit_code)
+        return
 
     if sub_command is None:
-        commands.make_config_parser().print_help()
-        print_known_external_commands()
+        print_help()
         raise SystemExit(1)
     elif sub_command in internal_cmd():
         parser = commands.make_config_parser()
-        args, unknown = parser.parse_known_args()
-        if 'func' in args:
-            kwargs = vars(args)
-            func = kwargs.pop('func')
-            func(**kwargs)
-        else:
-            call = getattr(commands, sub_command)
-            call()
-    elif sub_command in external_subcmds():
-        execute_external(sub_command)
+        args, unknown = parser.parse_known_args(argv)
+        with global_options_applied(options):
+            if 'func' in args:
+                kwargs = vars(args)
+                func = kwargs.pop('func')
+                func(**kwargs)
+            else:
+                call = getattr(commands, sub_command)
+                call()
     else:
-        commands.make_config_parser().print_help()
-        print_known_external_commands()
-        raise SystemExit(1)
+        run_external(sub_command, argv)
 
 
 if __name__ == '__main__':
@@ -95,7 +252,7 @@ if __name__ == '__main__':
         sys.exit(1)
     except SystemExit:
         raise
-    except NotInWorkTree as e:
+    except (NotInWorkTree, FunctionNotAvailable) as e:
         print(e)
         raise SystemExit(1)
     except Exception as e:
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 
 import sys
-import csv
 import argparse
 
+from util.csvmerge import merge_files
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(prog="Moodle Destroyer", prefix_chars="-")
@@ -11,7 +12,7 @@ if __name__ == '__main__':
     parser.add_argument("-d", "--destroy",
                         nargs=2,
                         required=True,
-                        type=argparse.FileType('rU'),
+                        type=argparse.FileType('r'),
                         help="grading-file, moodle-file, result-file")
     parser.add_argument("-r", "--result",
                         nargs=1,
@@ -47,38 +48,12 @@ if __name__ == '__main__':
     else:
         raise Exception
 
-    with open(GRADING_FILE, 'rU', newline='') as grading, \
-         open(MOODLE_EXPORT, 'rU', newline='') as moodle, \
-         open(RESULT_FILE, 'w', newline='') as result:
-        reader_grading = csv.DictReader(grading)
-        reader_moodle = csv.DictReader(moodle)
-
-        header = reader_moodle.fieldnames
-        writer = csv.DictWriter(result,
-                                header,
-                                quotechar='"',
-                                quoting=csv.QUOTE_NONNUMERIC)
-        writer.writeheader()
-        moodlelist = []
-        gradinglist = []
-
-        for line in reader_moodle:
-            moodlelist.append(line)
-        for line in reader_grading:
-            gradinglist.append(line)
+    written, unmatched_grading, unmatched_moodle, duplicates = \
+        merge_files(GRADING_FILE, MOODLE_EXPORT, RESULT_FILE, single=args.single, feedback=args.feedback)
 
-        for line in gradinglist:
-            for row in moodlelist:
-                # print(line['Gruppe'],"\nrow:",row['Gruppe'])
-                if args.single:
-                    if line['Vollständiger Name'] == row['Vollständiger Name']:
-                        row['Bewertung'] = line['Bewertung']
-                        if args.feedback:
-                            row['Feedback als Kommentar'] = line['Feedback als Kommentar']
-                        writer.writerow(row)
-                else:
-                    if line['Gruppe'] == row['Gruppe']:
-                        row['Bewertung'] = line['Bewertung']
-                        if args.feedback:
-                            row['Feedback als Kommentar'] = line['Feedback als Kommentar']
-                        writer.writerow(row)
+    for key in duplicates:
+        print("duplicate in grading-file, using last: " + key)
+    for key in unmatched_grading:
+        print("not found in moodle-file: " + key)
+    for key in unmatched_moodle:
+        print("not found in grading-file: " + key)
@@ -0,0 +1,113 @@
+import copy
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+
+from util import serialization
+
+
+def default_cache_dir():
+    try:
+        return Path(os.environ['XDG_CACHE_HOME']) / 'mdt'
+    except KeyError:
+        return Path.home() / '.cache' / 'mdt'
+
+
+def cache_key(ws_function, args, token, url='', variant=()):
+    """
+    sha256 over function, arguments, token and site, so tokens of different users never share entries.
+
+    :param variant: whatever else shapes the stored payload, like the language mlang texts were reduced to
+    """
+    normalized = serialization.dumpb([ws_function, sorted((args or {}).items()), token, url, list(variant)],
+                                     compact_output=True)
+    return hashlib.sha256(normalized).hexdigest()
+
+
+class SingleFlight:
+    """
+    Runs a function once per key at a time: callers asking for a key that is already in flight
+    wait for that call and get a copy of its result, or its exception.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class ResponseCache:
+    """
+    Decoded responses on disk, one file per key, valid for ttl seconds.
+    The token is part of the key, but never written; the folder is only readable by the user.
+    """
+
+    def __init__(self, path=None, ttl=600):
+        self.path = Path(path) if path is not None else default_cache_dir()
+        self.ttl = ttl
+
+    def _file(self, ws_function, key):
+        return self.path / ws_function / key
+
+    def get(self, ws_function, key):
+        """:returns the cached payload, or None if there is none, or it is too old"""
+        file = self._file(ws_function, key)
+        try:
+            if time.time() - file.stat().st_mtime > self.ttl:
+                return None
+            return serialization.read_file(file)
+        except (OSError, serialization.DecodeError):
+            return None
+
+    def put(self, ws_function, key, payload):
+        file = self._file(ws_function, key)
+        try:
+            self.path.mkdir(mode=0o700, parents=True, exist_ok=True)
+            file.parent.mkdir(mode=0o700, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=str(file.parent))
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(serialization.dumpb(payload, True))
+            os.replace(tmp, str(file))
+        except OSError:
+            pass  # a cache, that can't be written, is no reason to fail.
+
+    def invalidate(self, ws_function):
+        """drops all cached responses of ws_function, e.g. after a call that changes them"""
+        for file in (self.path / ws_function).glob('*'):
+            try:
+                file.unlink()
+            except OSError:
+                pass
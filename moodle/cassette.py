@@ -0,0 +1,207 @@
+import gzip
+import hashlib
+import io
+import threading
+import time
+import zipfile
+
+from collections import defaultdict, deque
+
+import requests
+
+from moodle.fieldnames import JsonFieldNames as Jn
+from util import serialization
+
+# values of these keys are replaced by pseudonyms when recording.
+personal_fields = {
+    'fullname', 'firstname', 'lastname', 'username', 'email', 'idnumber', 'address', 'phone1', 'phone2',
+    'city', 'country', 'institution', 'department', 'description', 'interests', 'lastip',
+    'profileimageurl', 'profileimageurlsmall', 'icq', 'skype', 'yahoo', 'aim', 'msn', 'author',
+}
+# submitted content, replaced by filler of the same length, to keep the payload size.
+content_fields = {'text'}
+file_name_fields = {'filename'}
+file_url_fields = {'fileurl', 'url'}
+# arguments never written to a cassette.
+secret_args = {Jn.ws_token, Jn.token, Jn.password}
+
+
+class CassetteMiss(Exception):
+    def __init__(self, ws_function):
+        self.message = f'the cassette has no recorded response for {ws_function}'
+
+    def __str__(self):
+        return self.message
+
+
+def pseudonym(value):
+    """same value, same pseudonym, roughly the same length"""
+    digest = hashlib.sha1(value.encode()).hexdigest()
+    return (digest * (len(value) // len(digest) + 1))[:max(len(value), 8)]
+
+
+def pseudonym_file_name(name):
+    stem, dot, extension = name.rpartition('.')
+    if not dot:
+        return pseudonym(name)
+    return pseudonym(stem) + '.' + extension
+
+
+def scrub(data):
+    """returns a copy of decoded json data, without personal data"""
+    if isinstance(data, list):
+        return [scrub(item) for item in data]
+    if not isinstance(data, dict):
+        return data
+    scrubbed = {}
+    for key, value in data.items():
+        if not isinstance(value, str) or value == '':
+            scrubbed[key] = scrub(value)
+        elif key in personal_fields:
+            scrubbed[key] = pseudonym(value)
+        elif key in content_fields:
+            scrubbed[key] = 'x' * len(value)
+        elif key in file_name_fields:
+            scrubbed[key] = pseudonym_file_name(value)
+        elif key in file_url_fields and 'pluginfile.php' in value:
+            scrubbed[key] = scrub_file_url(value)
+        else:
+            scrubbed[key] = value
+    return scrubbed
+
+
+def scrub_file_url(url):
+    url, _, _ = url.partition('?')
+    head, _, name = url.rpartition('/')
+    return head + '/' + pseudonym_file_name(name)
+
+
+def normalize_args(args):
+    normalized = []
+    for key, value in sorted((args or {}).items()):
+        if key in secret_args:
+            continue
+        if isinstance(value, (str, int, float, bool)) or value is None:
+            normalized.append([key, value])
+        else:
+            normalized.append([key, list(value)])
+    return normalized
+
+
+class Cassette:
+    """
+    Records the web service calls of a session to a gzipped file of json lines,
+    or replays them, without any network access.
+
+    Tokens and passwords are never written, personal data is replaced by pseudonyms,
+    submitted text by filler of the same length. Downloads are recorded by size only
+    and replayed as as many zero bytes.
+
+    Replay looks for a call with the same function and arguments first, if there is none,
+    the next recorded call of the same function is used. So a cassette also replays,
+    when timestamps like `since` differ.
+    """
+    version = 1
+    record_mode = 'record'
+    replay_mode = 'replay'
+
+    def __init__(self, path, mode, token=None):
+        self.path = path
+        self.mode = mode
+        self.token = token
+        self._lock = threading.Lock()
+        self._calls = defaultdict(deque)  # (function, args): deque of entries
+        self._by_function = defaultdict(deque)  # function: deque of entries
+        self._files = {}  # url: size
+        self._file = None
+
+        if mode == self.record_mode:
+            self._file = gzip.open(path, 'wt', encoding='utf-8')
+            self._write({'kind': 'header', 'version': self.version, 'time': int(time.time())})
+        elif mode == self.replay_mode:
+            self._load()
+        else:
+            raise ValueError(f'unknown cassette mode: {mode}')
+
+    @property
+    def replaying(self):
+        return self.mode == self.replay_mode
+
+    def _load(self):
+        with gzip.open(self.path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                entry = serialization.loads(line)
+                if entry['kind'] == 'ws':
+                    key = (entry['function'], serialization.dumps(entry['args'], compact_output=True))
+                    self._calls[key].append(entry)
+                    self._by_function[entry['function']].append(entry)
+                elif entry['kind'] == 'file':
+                    self._files[entry['url']] = entry['size']
+
+    def _write(self, entry):
+        line = serialization.dumps(entry, compact_output=True)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def _scrub_text(self, text):
+        if self.token:
+            text = text.replace(self.token, 'scrubbed')
+        try:
+            return serialization.dumps(scrub(serialization.loads(text)), compact_output=True)
+        except serialization.DecodeError:
+            return text
+
+    def record(self, ws_function, args, text, elapsed=0.0):
+        self._write({
+            'kind': 'ws',
+            'function': ws_function,
+            'args': normalize_args(args),
+            'bytes': len(text),
+            'elapsed': round(elapsed, 6),
+            'response': self._scrub_text(text),
+        })
+
+    def replay(self, ws_function, args):
+        key = (ws_function, serialization.dumps(normalize_args(args), compact_output=True))
+        with self._lock:
+            entry = self._next(self._calls.get(key)) or self._next(self._by_function.get(ws_function))
+        if entry is None:
+            raise CassetteMiss(ws_function)
+        return entry['response']
+
+    @staticmethod
+    def _next(entries):
+        """the next unused entry, the last one is reused for calls repeated more often than recorded"""
+        if not entries:
+            return None
+        while len(entries) > 1 and entries[0].get('used', False):
+            entries.popleft()
+        entry = entries[0]
+        if len(entries) > 1:
+            entries.popleft()
+        entry['used'] = True
+        return entry
+
+    def record_download(self, url, size):
+        self._write({'kind': 'file', 'url': scrub_file_url(url), 'size': size})
+
+    def replay_download(self, url):
+        """url is replayed too, so it is scrubbed already, scrubbing is not idempotent"""
+        url, _, _ = url.partition('?')
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        content = bytes(self._files.get(url, 0))
+        if url.endswith('.zip'):  # pull unpacks zip files, so they have to be valid.
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w') as archive:
+                archive.writestr('replayed', content)
+            content = buffer.getvalue()
+        response._content = content
+        response._content_consumed = True  # iter_content reads from _content, not from a connection.
+        return response
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
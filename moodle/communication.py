@@ -1,35 +1,145 @@
+import hashlib
 import mimetypes
 import os
-import json
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from moodle.exceptions import MoodleException
+from moodle.caching import ResponseCache, SingleFlight, cache_key
+from moodle.cassette import CassetteMiss
+from moodle.exceptions import FileTooLarge, MoodleException
+from moodle.instrumentation import download_function
 
 from moodle.fieldnames import text_format as moodle_text_format
 from moodle.fieldnames import JsonFieldNames as Jn
-from moodle.parsers import strip_mlang
+from moodle.parsers import strip_mlang, strip_mlang_fields, default_lang
+from moodle.parsers import text_mode as mlang_text_mode, fields_mode as mlang_fields_mode
+from util import serialization
 
 import logging
 
 log = logging.getLogger('moodle.communication')
 
 
+class ReadRetry(Retry):
+    """
+    Does not retry the requests a thread sends inside writing(): moodle may have applied a write,
+    even if its response was lost. Failed connections are retried anyway, nothing was sent then.
+    """
+    _state = threading.local()
+
+    @classmethod
+    @contextmanager
+    def writing(cls):
+        cls._state.writing = True
+        try:
+            yield
+        finally:
+            cls._state.writing = False
+
+    def _is_method_retryable(self, method):
+        if getattr(self._state, 'writing', False):
+            return False
+        return super()._is_method_retryable(method)
+
+
 class MoodleSessionCore(requests.Session):
     ws_path = '/webservice/rest/server.php'
-
-    def __init__(self, moodle_url, token=None, rest_format='json'):
+    # read only functions, whose responses are coalesced and cached on disk.
+    cached_functions = frozenset()
+    # functions changing data on moodle, never retried.
+    write_functions = frozenset()
+
+    def __init__(self, moodle_url, token=None, rest_format='json', cassette=None, stats=None,
+                 preferred_lang=default_lang, mlang_mode=mlang_text_mode, pool_size=10, retries=0, cache_ttl=0,
+                 cache_dir=None):
+        """
+        :param preferred_lang: the language kept from {mlang} multi language texts
+        :param mlang_mode: 'text' strips mlang tags from the raw response, 'fields' only from
+            user visible string values after decoding, see moodle.parsers.strip_mlang_fields
+        :param pool_size: connections kept open to moodle, should match the number of threads using the session
+        :param retries: how often failed connections and 502, 503 and 504 responses are retried,
+            the latter not for write_functions and uploads
+        :param cache_ttl: seconds responses of cached_functions are kept on disk, 0 disables the cache
+        :param cache_dir: where to keep them, default: $XDG_CACHE_HOME/mdt or ~/.cache/mdt
+        """
         super().__init__()
+        if mlang_mode not in (mlang_text_mode, mlang_fields_mode):
+            raise ValueError(f'unknown mlang mode: {mlang_mode}')
         self.token = token
-
-        if moodle_url.startswith('http://'):
-            moodle_url = 'https://' + moodle_url[4:]
-        if not moodle_url.startswith('https://'):
+        self.preferred_lang = preferred_lang
+        self.mlang_mode = mlang_mode
+        self.cassette = cassette
+        self.stats = stats
+        if cassette is not None:
+            cassette.token = token
+        if stats is not None:
+            stats.add_session(self)
+        self.single_flight = SingleFlight()
+        self.cache = None
+        if cache_ttl > 0 and cassette is None:  # cassettes should see every call.
+            self.cache = ResponseCache(cache_dir, cache_ttl)
+
+        # web service calls and file downloads share one pool per host. Blocking keeps threads
+        # waiting for a free connection, instead of opening and discarding extra ones.
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True,
+                                   max_retries=ReadRetry(total=retries, backoff_factor=0.5, allowed_methods=None,
+                                                     status_forcelist=(502, 503, 504), raise_on_status=False))
+        self.mount('https://', self.adapter)
+        self.mount('http://', self.adapter)
+
+        if moodle_url.startswith('http://') and not self.is_loopback(moodle_url):
+            moodle_url = 'https://' + moodle_url[7:]
+        if not moodle_url.startswith(('https://', 'http://')):
             moodle_url = 'https://' + moodle_url
         self.rest_format = rest_format
         self.url = moodle_url
 
+    def connection_stats(self):
+        """requests sent and connections opened, every other request reused a kept alive connection"""
+        pools = self.adapter.poolmanager.pools
+        requests_sent = connections = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_sent += pool.num_requests
+                connections += pool.num_connections
+        return {
+            'requests': requests_sent,
+            'new_connections': connections,
+            'reused_connections': max(requests_sent - connections, 0),
+        }
+
+    @staticmethod
+    def is_loopback(url):
+        """plain http is only kept for local servers, like the stand-in in benchmarks.server"""
+        return urlsplit(url).hostname in ('localhost', '127.0.0.1', '::1')
+
     def post_web_service(self, ws_function, args=None):
+        if ws_function not in self.cached_functions:
+            return self._post_web_service(ws_function, args)
+
+        key = cache_key(ws_function, args, self.token, self.url, (self.preferred_lang, self.mlang_mode))
+        return self.single_flight.do(key, lambda: self._cached_post_web_service(key, ws_function, args))
+
+    def _cached_post_web_service(self, key, ws_function, args):
+        if self.cache is not None:
+            payload = self.cache.get(ws_function, key)
+            if payload is not None:
+                if self.stats is not None:
+                    self.stats.record(ws_function, 0.0, cached=True)
+                return payload
+        payload = self._post_web_service(ws_function, args)
+        if self.cache is not None:
+            self.cache.put(ws_function, key, payload)
+        return payload
+
+    def _post_web_service(self, ws_function, args=None):
         needed_args = {
             Jn.moodle_ws_rest_format: self.rest_format,
             Jn.ws_token: self.token,
@@ -40,19 +150,62 @@ class MoodleSessionCore(requests.Session):
         else:
             args.update(needed_args)
 
-        response = self.post(self.url + self.ws_path, args)
+        start = time.perf_counter()
+        response = None
+        if self.cassette is not None and self.cassette.replaying:
+            text = self.cassette.replay(ws_function, args)
+        else:
+            if ws_function in self.write_functions:
+                with ReadRetry.writing():
+                    response = self.post(self.url + self.ws_path, args)
+            else:
+                response = self.post(self.url + self.ws_path, args)
+            text = response.text
+            if self.cassette is not None:
+                self.cassette.record(ws_function, args, text, time.perf_counter() - start)
+        latency = time.perf_counter() - start
 
         if 'json' != self.rest_format:
-            return response.text
+            self._record_stats(ws_function, latency, response, text)
+            return text
 
+        error = True
+        timings = {}
         try:
-            payload = json.loads(strip_mlang(response.text))
+            if self.mlang_mode == mlang_fields_mode:
+                before = time.perf_counter()
+                payload = serialization.loads(text)
+                timings['decode'] = time.perf_counter() - before
+                before = time.perf_counter()
+                payload = strip_mlang_fields(payload, self.preferred_lang)
+                timings['strip_mlang'] = time.perf_counter() - before
+            else:
+                before = time.perf_counter()
+                stripped = strip_mlang(text, self.preferred_lang)
+                timings['strip_mlang'] = time.perf_counter() - before
+                before = time.perf_counter()
+                payload = serialization.loads(stripped)
+                timings['decode'] = time.perf_counter() - before
             if isinstance(payload, dict) and 'exception' in payload:
                 raise MoodleException.generate_exception(**payload)
+            error = False
             return payload
-        except json.JSONDecodeError:
-            log.error(f'moodle sent an unexpected response:\n {response.text}')
+        except serialization.DecodeError:
+            log.error(f'moodle sent an unexpected response:\n {text}')
             raise SystemExit(1)
+        finally:
+            self._record_stats(ws_function, latency, response, text, error=error, **timings)
+
+    def _record_stats(self, ws_function, latency, response, text, **kwargs):
+        if self.stats is None:
+            return
+        if response is None:  # replayed from a cassette
+            self.stats.record(ws_function, latency, response_bytes=len(text), **kwargs)
+            return
+        self.stats.record(ws_function, latency,
+                          request_bytes=self.stats.request_bytes_of(response),
+                          response_bytes=len(response.content),
+                          retries=self.stats.retries_of(response), **kwargs)
 
     def get_token(self, user_name, password, service='moodle_mobile_app'):
         """
@@ -70,6 +223,8 @@ class MoodleSessionCore(requests.Session):
         :return: a token or one of many exceptions -.-
         """
         endpoint = '/login/token.php'
+        if self.cassette is not None and self.cassette.replaying:
+            raise CassetteMiss(endpoint)  # tokens are never recorded.
         data = {
             Jn.user_name: user_name,
             Jn.password: password,
@@ -78,8 +233,8 @@ class MoodleSessionCore(requests.Session):
         response = self.post(self.url + endpoint, data)
 
         try:
-            payload = response.json()
-        except json.JSONDecodeError:
+            payload = serialization.loads(response.text)
+        except serialization.DecodeError:
             log.error(f'Moodle returned unexpected values, expected valid json:\n {response.text}')
             raise SystemExit(1)
 
@@ -93,6 +248,8 @@ class MoodleSessionCore(requests.Session):
 
     def upload_files(self, fd_list, file_path='/', file_area='draft', item_id=0):
         endpoint = '/webservice/upload.php'
+        if self.cassette is not None and self.cassette.replaying:
+            raise CassetteMiss(endpoint)
         mimetypes.init()
 
         upload_info = []
@@ -111,25 +268,95 @@ class MoodleSessionCore(requests.Session):
             Jn.token: self.token
         }
 
-        response = self.post(self.url + endpoint, data, files=upload_info)
+        with ReadRetry.writing():
+            response = self.post(self.url + endpoint, data, files=upload_info)
         if 'json' != self.rest_format:
             return response.text
 
         try:
-            payload = json.loads(response.text)
+            payload = serialization.loads(response.text)
             if isinstance(payload, dict) and 'exception' in payload:
                 raise MoodleException.generate_exception(**payload)
             return payload
-        except json.JSONDecodeError:
+        except serialization.DecodeError:
             log.error(f'moodle sent an unexpected response, expected valid json:\n {response.text}')
             raise SystemExit(1)
 
     def download_file(self, file_url):
-        args = {Jn.token: self.token}
-        return self.post(file_url, args)
+        start = time.perf_counter()
+        if self.cassette is not None and self.cassette.replaying:
+            response = self.cassette.replay_download(file_url)
+        else:
+            args = {Jn.token: self.token}
+            response = self.post(file_url, args)
+            if self.cassette is not None:
+                self.cassette.record_download(file_url, len(response.content))
+        if self.stats is not None:
+            self.stats.record(download_function, time.perf_counter() - start,
+                              request_bytes=self.stats.request_bytes_of(response),
+                              response_bytes=len(response.content),
+                              retries=self.stats.retries_of(response),
+                              error=not response.ok)
+        return response
+
+    def download_file_to(self, file_url, path, chunk_size=64 * 1024, throttle=None, meter=None, max_size=0):
+        """
+        Streams a file to path, without holding it in memory, and hashes it on the way.
+
+        :param throttle: a util.transfer.TokenBucket shared by all downloads, to cap their bandwidth
+        :param meter: a util.transfer.TransferMeter, counting the bytes as they arrive
+        :param max_size: stop with FileTooLarge after that many bytes, 0 for no limit
+        :raises requests.HTTPError: if moodle answers with an error status, nothing is written then
+        :returns the number of bytes written and their sha1, the hash moodle uses as contenthash
+        """
+        start = time.perf_counter()
+        if self.cassette is not None and self.cassette.replaying:
+            response = self.cassette.replay_download(file_url)
+        else:
+            args = {Jn.token: self.token}
+            response = self.post(file_url, args, stream=True)
+        size = 0
+        sha1 = hashlib.sha1()
+        try:
+            response.raise_for_status()
+            with open(path, 'wb') as file:
+                for chunk in response.iter_content(chunk_size):
+                    if throttle is not None:
+                        throttle.take(len(chunk))
+                    file.write(chunk)
+                    sha1.update(chunk)
+                    size += len(chunk)
+                    if meter is not None:
+                        meter.add(len(chunk))
+                    if 0 < max_size < size:
+                        raise FileTooLarge(file_url, max_size)
+        finally:
+            response.close()
+            if self.stats is not None:
+                self.stats.record(download_function, time.perf_counter() - start,
+                                  request_bytes=self.stats.request_bytes_of(response),
+                                  response_bytes=size,
+                                  retries=self.stats.retries_of(response),
+                                  error=not response.ok)
+        if self.cassette is not None and not self.cassette.replaying:
+            self.cassette.record_download(file_url, size)
+        return size, sha1.hexdigest()
 
 
 class MoodleSession(MoodleSessionCore):
+    cached_functions = frozenset([
+        'core_webservice_get_site_info',
+        'core_enrol_get_users_courses',
+        'core_course_search_courses',
+        'core_enrol_get_course_enrolment_methods',
+    ])
+    write_functions = frozenset([
+        'mod_assign_save_submission',
+        'mod_assign_save_grade',
+        'mod_assign_save_grades',
+        'enrol_self_enrol_user',
+    ])
+
     def mod_assign_save_submission(self, assignment_id, text='', text_format=0, text_file_id=0, files_id=0):
         data = {
             Jn.assignment_id: assignment_id,
@@ -179,6 +406,39 @@ class MoodleSession(MoodleSessionCore):
 
         return self.post_web_service('mod_assign_save_grade', args=data)
 
+    def mod_assign_save_grades(self, assignment_id, grades, apply_to_all=False):
+        """
+        Uploads grades for many users of one assignment in one call.
+
+        :param assignment_id: the graded assignment id
+        :param grades: list of dicts with user_id and grade, optionally feedback_text, feedback_format,
+            attempt_number, add_attempt, workflow_state, feedback_draft_area_id, see mod_assign_save_grade
+        :param apply_to_all: apply the grades to all members of the group (for group assignments)
+        :return:
+        """
+        data = {
+            Jn.assignment_id: assignment_id,
+            Jn.apply_to_all: 1 if apply_to_all else 0,
+        }
+        for num, grade in enumerate(grades):
+            entry = {
+                Jn.user_id: grade['user_id'],
+                Jn.grade: grade['grade'],
+                Jn.attempt_number: grade.get('attempt_number', -1),
+                Jn.add_attempt: 1 if grade.get('add_attempt', False) else 0,
+                Jn.workflow_state: grade.get('workflow_state', ''),
+                Jn.assign_feedback_text: grade.get('feedback_text', ''),
+                Jn.assign_feedback_format: moodle_text_format[grade.get('feedback_format', 'plain')],
+                Jn.assign_feedback_file: grade.get('feedback_draft_area_id', 0),
+            }
+            prefix = Jn.grades_entry.format(num)
+            for name, value in entry.items():
+                # plugindata[x][text] becomes grades[0][plugindata][x][text]
+                head, bracket, rest = name.partition('[')
+                data[f'{prefix}[{head}]{bracket}{rest}'] = value
+
+        return self.post_web_service('mod_assign_save_grades', args=data)
+
     def mod_assign_get_assignments(self, course_ids=None, capabilities=None, include_not_enrolled_courses=False):
         """
         Get the list of assignments, the current user has capabilities for.
@@ -315,7 +575,10 @@ class MoodleSession(MoodleSessionCore):
             Jn.password: password,
             Jn.instance_id: instance_id,
         }
-        return self.post_web_service('enrol_self_enrol_user', args=data)
+        response = self.post_web_service('enrol_self_enrol_user', args=data)
+        if self.cache is not None:  # the user is in another course now.
+            self.cache.invalidate('core_enrol_get_users_courses')
+        return response
 
     def gradereport_user_get_grades_table(self, course_id, user_id=0):
         """
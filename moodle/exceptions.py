@@ -85,3 +85,37 @@ class InvalidRecord(MoodleException):
 #   "errorcode": "invalidrecordunknown"
 #   "debuginfo": "SELECT md.name\n                                                 FROM {modules} md\n                                                 JOIN {course_modules} cm ON cm.module = md.id\n                                                WHERE cm.id = :cmid\n[array (\n  'cmid' => 117242,\n)]",
 # }
+
+
+class FunctionNotAvailable(Exception):
+    """
+    The web service of the token does not offer a function mdt needs, found out from the site info before
+    calling it. Not a MoodleException, moodle didn't raise it.
+    """
+    def __init__(self, missing):
+        self.missing = sorted(missing)
+
+    def __str__(self):
+        return 'the web service of your token does not offer: {}\n' \
+               'ask your moodle admin to add them, or to use another service, then run "mdt auth"'.format(
+                ', '.join(self.missing))
+
+
+class DownloadFailed(Exception):
+    """a file could not be downloaded, or did not match its size or contenthash, even after retrying"""
+    def __init__(self, path, reason):
+        self.path = path
+        self.reason = reason
+
+    def __str__(self):
+        return f'could not download {self.path}: {self.reason}'
+
+
+class FileTooLarge(Exception):
+    """a download exceeded the size limit of pull, it is stopped, not retried"""
+    def __init__(self, url, max_size):
+        self.url = url
+        self.max_size = max_size
+
+    def __str__(self):
+        return f'larger than the limit of {self.max_size:d} bytes'
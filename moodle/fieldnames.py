@@ -33,6 +33,7 @@ class JsonFieldNames:
     capabilities = 'capabilities[]'
     course_module_id = 'cmid'
     configs = 'configs'
+    content_hash = 'contenthash'
     contents = 'contents'
     course = 'course'
     course_id = 'courseid'
@@ -60,9 +61,11 @@ class JsonFieldNames:
     files = 'files'
     format = 'format'
     full_name = 'fullname'
+    functions = 'functions'
     grade = 'grade'
     grader = 'grader'
     grades = 'grades'
+    grades_entry = 'grades[{:d}]'
     group_id = 'groupid'
     groups = 'groups'
     id = 'id'
@@ -0,0 +1,152 @@
+import bisect
+import threading
+import time
+
+from util import serialization
+
+# upper bounds of the latency histogram buckets, in seconds.
+latency_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+download_function = 'download_file'
+
+
+def bucket_label(upper):
+    if upper is None:
+        return f'>{latency_buckets[-1]:g}s'
+    return f'<={upper:g}s'
+
+
+class FunctionStats:
+    """numbers collected for one wsfunction"""
+
+    def __init__(self):
+        self.calls = 0
+        self.cached = 0
+        self.errors = 0
+        self.retries = 0
+        self.latency = 0.0
+        self.latency_min = None
+        self.latency_max = 0.0
+        self.histogram = [0] * (len(latency_buckets) + 1)
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.strip_mlang = 0.0
+        self.decode = 0.0
+
+    def add(self, latency, request_bytes=0, response_bytes=0, retries=0, strip_mlang=0.0, decode=0.0, error=False,
+            cached=False):
+        if cached:  # answered from the disk cache, without a request.
+            self.cached += 1
+            return
+        self.calls += 1
+        self.errors += int(error)
+        self.retries += retries
+        self.latency += latency
+        self.latency_min = latency if self.latency_min is None else min(self.latency_min, latency)
+        self.latency_max = max(self.latency_max, latency)
+        self.histogram[bisect.bisect_left(latency_buckets, latency)] += 1
+        self.request_bytes += request_bytes
+        self.response_bytes += response_bytes
+        self.strip_mlang += strip_mlang
+        self.decode += decode
+
+    def as_dict(self):
+        uppers = latency_buckets + [None]
+        return {
+            'calls': self.calls,
+            'cached': self.cached,
+            'errors': self.errors,
+            'retries': self.retries,
+            'latency': {
+                'total': self.latency,
+                'mean': self.latency / self.calls if self.calls else 0.0,
+                'min': self.latency_min or 0.0,
+                'max': self.latency_max,
+                'histogram': {bucket_label(u): n for u, n in zip(uppers, self.histogram) if n > 0},
+            },
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+            'strip_mlang_seconds': self.strip_mlang,
+            'decode_seconds': self.decode,
+        }
+
+
+class SessionStats:
+    """
+    Collects per wsfunction call counts, latencies, payload sizes and parse times of MoodleSessions.
+    One instance can be shared by sessions in multiple threads.
+
+    Latency is the time from sending the request to having read the full response,
+    so together with strip_mlang and decode seconds it tells, whether moodle and the network,
+    or our own parsing are slow.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._functions = {}
+        self._sessions = []
+
+    def add_session(self, session):
+        """sessions recording here, to collect their connection counters"""
+        with self._lock:
+            self._sessions.append(session)
+
+    def record(self, ws_function, latency, **kwargs):
+        """
+        :param ws_function: the called function, download_function for file downloads
+        :param latency: seconds until the response was read
+        :param kwargs: request_bytes, response_bytes, retries, strip_mlang, decode, error, cached; see FunctionStats.add
+        """
+        with self._lock:
+            stats = self._functions.get(ws_function)
+            if stats is None:
+                stats = self._functions[ws_function] = FunctionStats()
+            stats.add(latency, **kwargs)
+
+    @staticmethod
+    def retries_of(response):
+        """the number of retries urllib3 needed for a requests.Response"""
+        retries = getattr(response.raw, 'retries', None)
+        if retries is None:
+            return 0
+        return len(retries.history)
+
+    @staticmethod
+    def request_bytes_of(response):
+        if response.request is None:  # replayed from a cassette
+            return 0
+        body = response.request.body
+        if body is None:
+            return 0
+        if isinstance(body, str):
+            return len(body.encode())
+        try:
+            return len(body)
+        except TypeError:  # streamed bodies, like file uploads.
+            return int(response.request.headers.get('Content-Length', 0))
+
+    def as_dict(self):
+        with self._lock:
+            functions = {name: stats.as_dict() for name, stats in sorted(self._functions.items())}
+            sessions = list(self._sessions)
+        totals = {
+            key: sum(f[key] for f in functions.values())
+            for key in ('calls', 'cached', 'errors', 'retries', 'request_bytes', 'response_bytes',
+                        'strip_mlang_seconds', 'decode_seconds')
+        }
+        totals['latency_seconds'] = sum(f['latency']['total'] for f in functions.values())
+        connections = {'requests': 0, 'new_connections': 0, 'reused_connections': 0}
+        for session in sessions:
+            for key, value in session.connection_stats().items():
+                connections[key] += value
+        return {
+            'connections': connections,
+            'started': int(self.started),
+            'wall_seconds': time.time() - self.started,
+            'totals': totals,
+            'functions': functions,
+        }
+
+    def dump(self, file):
+        file.write(serialization.dumps(self.as_dict()))
+        file.write('\n')
@@ -1,4 +1,4 @@
-from collections import Mapping, Sequence, Sized, namedtuple as nt
+from collections.abc import Mapping, Sequence, Sized
 
 from moodle.fieldnames import JsonFieldNames as Jn
 
@@ -642,6 +642,11 @@ class FileMetaDataResponse(JsonDictWrapper):
             @property
             def license(self): return self.get(Jn.license, "")
 
+            @property
+            def content_hash(self):
+                """sha1 of the content, only sent by some moodle versions"""
+                return self.get(Jn.content_hash, None)
+
 
 class CourseContentResponse(JsonListWrapper):
     def __iter__(self):
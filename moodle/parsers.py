@@ -1,37 +1,90 @@
+import functools
 import re
 
 mlang_tags = re.compile(r'\{mlang\s*(\w{2})\}')
+# removes every remaining {mlang …} tag, with surrounding white space.
+strip_mlang_tag = re.compile(r'\s*\{mlang.*?\}\s*')
+default_lang = 'en'
 
 
-def strip_mlang(string, preferred_lang='en'):
-    # todo make preferred language configurable
-    # creates mlang tuples like ('en', 'eng text')
-    # tuple_regex = re.compile(r'(?:\{mlang (\w{2})\}(.+?)\{mlang\})+?', flags=re.S)
-    # tuples = tuple_regex.findall(string)
+@functools.lru_cache(maxsize=64)
+def discard_mlang_pattern(languages):
+    """
+    a pattern removing the {mlang xx}…{mlang} blocks of the given languages
 
-    # creates set with possible languages like {'en', 'de'}
+    :param languages: sorted tuple of language codes
+    """
+    return re.compile(r'\{mlang (?:' + '|'.join(map(re.escape, languages)) + r')\}.*?\{mlang\}', flags=re.S)
+
+
+def strip_mlang(string, preferred_lang=default_lang):
     """
     Strips all {mlang} tags from a string.
     Also strips content between tags except for tags matching preferred_lang.
 
+    Text without mlang tags is returned as is, without any regex scan, the patterns for
+    each set of languages are compiled only once.
+
     :param string: The string, possibly containing mlang tags
     :param preferred_lang: Strip all mlang content extept this, default: en
     :return: stripped text, free of mlang tags, only containing preferred_lang content.
     """
+    if '{mlang' not in string:
+        return string
+
+    # creates set with possible languages like {'en', 'de'}
     lang_set = set(mlang_tags.findall(string))
 
     # if there is more than one language, discard all but preferred_lang
     if len(lang_set) > 1:
-        lang_set.discard(preferred_lang)  # removes preferred lang from set, langs in set will be purged
-        discard_mlang = '|'.join(lang_set)
-        pattern = re.compile(r'((?=\{mlang (' + discard_mlang + r')\})(.*?)\{mlang\})+?', flags=re.S)
-        string = pattern.sub('', string)
+        lang_set.discard(preferred_lang)  # langs left in set will be purged
+        string = discard_mlang_pattern(tuple(sorted(lang_set))).sub('', string)
 
     # remove remaining mlang tags.
-    strip_mlang_tag = re.compile(r'(\s*\{mlang.*?\}\s*)+?')
     return strip_mlang_tag.sub('', string)
 
 
+# keys of decoded responses holding user visible, possibly multi language, text: names, intros and editor fields.
+mlang_fields = frozenset([
+    'name', 'fullname', 'shortname', 'displayname', 'sitename', 'groupname', 'summary', 'intro', 'description',
+    'text', 'feedback', 'content',
+])
+text_mode = 'text'
+fields_mode = 'fields'
+
+
+@functools.lru_cache(maxsize=4096)
+def _strip_mlang_cached(string, preferred_lang):
+    return strip_mlang(string, preferred_lang)
+
+
+def strip_mlang_fields(data, preferred_lang=default_lang, fields=mlang_fields):
+    """
+    Strips {mlang} tags from decoded json, in place, but only from string values of keys in fields.
+    Unlike strip_mlang on the raw response, numbers, urls and other values are not scanned
+    and tags can't break the json. Languages are chosen per value, not per response.
+    Repeated values, like course names in every submission, are stripped only once.
+
+    :param data: decoded json
+    :param preferred_lang: Strip all mlang content except this
+    :param fields: the keys to strip
+    :return: data
+    """
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if isinstance(value, str):
+                    if key in fields and '{mlang' in value:
+                        node[key] = _strip_mlang_cached(value, preferred_lang)
+                elif isinstance(value, (dict, list)):
+                    stack.append(value)
+        elif isinstance(node, list):
+            stack.extend(item for item in node if isinstance(item, (dict, list)))
+    return data
+
+
 parse_args_from_url = re.compile(r'.*pluginfile.php'
                                  r'/(?P<context_id>[0-9]*)'
                                  r'/(?P<component>\w+)'
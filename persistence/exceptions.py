@@ -0,0 +1,6 @@
+class NotInWorkTree(Exception):
+    def __init__(self):
+        self.message = 'You are not in an initialized work tree. Go get one.'
+
+    def __str__(self):
+        return self.message
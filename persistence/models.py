@@ -1,22 +1,22 @@
-import json
 import os
+import threading
+import time
 
 from pathlib import Path
-from collections import Mapping
+from collections.abc import Mapping
 from abc import abstractmethod
 
 import moodle.models as models
+from util import serialization
 # TODO, mebbe add locks for async usage.
 
 
 def _read_json(filename):
-    with open(filename) as file:
-        return json.load(file)
+    return serialization.read_file(filename)
 
 
-def _dump_json(filename, data):
-    with open(filename, 'w') as file:
-        json.dump(data, file, indent=2, ensure_ascii=False, sort_keys=True)
+def _dump_json(filename, data, compact_output=False):
+    serialization.write_file(filename, data, compact_output)
 
 
 class CachedMapping(Mapping):
@@ -71,9 +71,10 @@ class CachedJsonFile(CachedFileMapping):
 
 
 class JsonDataFolder(CachedMapping):
-    def __init__(self, root_folder: Path, init=False):
+    def __init__(self, root_folder: Path, init=False, compact_output=False):
         super().__init__()
         self._folder = root_folder / self.folder_name
+        self._compact_output = compact_output
         if init:
             self._folder.mkdir(exist_ok=True)
 
@@ -86,7 +87,7 @@ class JsonDataFolder(CachedMapping):
 
     def _write_data(self, key, value):  # CachedMutableMapping
         filename = self._folder / str(key)
-        _dump_json(filename, value)
+        _dump_json(filename, value, self._compact_output)
 
     def _setitem(self, key, value):
         self._cache[key] = value
@@ -108,8 +109,8 @@ class JsonDataFolder(CachedMapping):
 class JsonMetaDataFolder(JsonDataFolder):
     _meta_file_suffix = '_meta'
 
-    def __init__(self, root_folder: Path, init=False):
-        super().__init__(root_folder, init)
+    def __init__(self, root_folder: Path, init=False, compact_output=False):
+        super().__init__(root_folder, init, compact_output)
         self._meta_file_path = root_folder / (self.folder_name + self._meta_file_suffix)
         self._read_meta()
 
@@ -124,7 +125,7 @@ class JsonMetaDataFolder(JsonDataFolder):
 
     def _write_meta(self):
         meta = {k: v for k, v in vars(self).items() if not k.startswith('_')}
-        _dump_json(self._meta_file_path, meta)
+        _dump_json(self._meta_file_path, meta, self._compact_output)
 
     def __iter__(self):
         for file in self._folder.iterdir():
@@ -180,6 +181,15 @@ class SubmissionFolder(JsonMetaDataFolder):
         self._setitem(assignment_id, raw)
 
     def update(self, json_data, time_of_sync):
+        result = self.merge(json_data)
+        self.mark_synced(time_of_sync)
+        return result
+
+    def merge(self, json_data):
+        """
+        merges a mod_assign_get_submissions response, without moving last_sync.
+        For partial syncs, that call mark_synced once all assignments are merged.
+        """
         result = dict.fromkeys(['new', 'updated', 'unchanged'], 0)
         response = models.AssignmentSubmissionResponse(json_data)
         for assignment in response.assignments:
@@ -191,9 +201,11 @@ class SubmissionFolder(JsonMetaDataFolder):
                 self._setitem(assignment.id, assignment.submissions.raw)
             else:
                 result['unchanged'] += 1
+        return result
+
+    def mark_synced(self, time_of_sync):
         self.last_sync = time_of_sync
         self._write_meta()
-        return result
 
 
 class GradeFolder(JsonMetaDataFolder):
@@ -213,6 +225,12 @@ class GradeFolder(JsonMetaDataFolder):
         self._setitem(assignment_id, raw)
 
     def update(self, json_data, time_of_sync):
+        result = self.merge(json_data)
+        self.mark_synced(time_of_sync)
+        return result
+
+    def merge(self, json_data):
+        """merges a mod_assign_get_grades response, without moving last_sync, see SubmissionFolder.merge"""
         # g_config_file = self.grade_meta + str(assignment[Jn.assignment_id])
         # self._write_meta(g_config_file, assignment)
         response = models.AssignmentGradeResponse(json_data)
@@ -226,10 +244,244 @@ class GradeFolder(JsonMetaDataFolder):
                 result['new'] += 1
             else:
                 result['unchanged'] += 1
+        return result
+
+    def mark_synced(self, time_of_sync):
+        self.last_sync = time_of_sync
+        self._write_meta()
+
+
+def file_meta_key(context_id, component, file_area, item_id, file_path, file_name):
+    """identifies a file independent of the url it was seen with, like /105864/assignsubmission_file/…/a.zip"""
+    return f'/{int(context_id):d}/{component}/{file_area}/{int(item_id):d}{file_path}{file_name}'
+
+
+class FileMetaFolder(JsonMetaDataFolder):
+    """
+    core_files_get_files results of submission files, per assignment id:
+    author, size, timestamps and, if moodle sends it, the contenthash.
+    """
+    @property
+    def folder_name(self):
+        return 'files'
+
+    last_sync = 0
+
+    def __iter__(self):
+        if self._folder.is_dir():
+            yield from super().__iter__()
+
+    def __len__(self):
+        return len(list(self.__iter__()))
+
+    def _write_data(self, key, value):
+        self._folder.mkdir(exist_ok=True)  # work trees from before file meta data was synced.
+        super()._write_data(key, value)
+
+    @staticmethod
+    def key_of(meta):
+        return file_meta_key(meta.context_id, meta.component, meta.file_area, meta.item_id, meta.file_path,
+                             meta.filename)
+
+    def update(self, files_by_assignment, time_of_sync):
+        """
+        :param files_by_assignment: {assignment id: [raw core_files_get_files entries]}
+        :param time_of_sync: stored as last_sync
+        """
+        result = dict.fromkeys(['new', 'updated', 'unchanged'], 0)
+        for assignment_id, files in files_by_assignment.items():
+            try:
+                local = {self.key_of(f): f for f in models.FileMetaDataResponse.FileList(self[assignment_id])}
+            except KeyError:
+                local = {}
+            changed = False
+            for file in models.FileMetaDataResponse.FileList(files):
+                key = self.key_of(file)
+                known = local.get(key)
+                if known is None:
+                    result['new'] += 1
+                elif known.raw != file.raw:
+                    result['updated'] += 1
+                else:
+                    result['unchanged'] += 1
+                    continue
+                local[key] = file
+                changed = True
+            if changed:
+                self._setitem(assignment_id, [f.raw for f in local.values()])
         self.last_sync = time_of_sync
         self._write_meta()
         return result
 
+    def index(self):
+        """all stored file meta data by file_meta_key"""
+        files = {}
+        for assignment_id in self:
+            for file in models.FileMetaDataResponse.FileList(self[assignment_id]):
+                files[self.key_of(file)] = file
+        return files
+
+
+class DownloadIndex:
+    """
+    What pull downloaded, by file_meta_key: size and timemodified as moodle listed them, the sha1 of the
+    received bytes and where they were written. Needed, as zip files are removed after unpacking,
+    so the files on disk can't tell what was downloaded.
+    Also the watermark of every assignment: the newest submission timemodified its last complete pull saw.
+    """
+
+    def __init__(self, path, compact_output=False):
+        self._path = path
+        self._compact_output = compact_output
+        try:
+            data = _read_json(path)
+        except (OSError, serialization.DecodeError):
+            data = {}
+        self._entries = data.get('files', {})
+        self._pulled = data.get('pulled', {})
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def is_current(self, key, size, time_modified, content_hash=None):
+        """
+        A file is current, if its contenthash equals the sha1 of the last download.
+        Without contenthash, like from moodle 3.1, size and timemodified have to be unchanged.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        if content_hash is not None:
+            return entry['sha1'] == content_hash
+        if size is None or time_modified is None:
+            return False
+        return entry['size'] == size and entry['timemodified'] == time_modified
+
+    def add(self, key, path, size, time_modified, sha1):
+        self._entries[key] = {
+            'path': str(path),
+            'size': size,
+            'timemodified': time_modified,
+            'sha1': sha1,
+        }
+
+    def pulled_until(self, assignment_id):
+        """the watermark of the assignment, 0 if it was never pulled completely"""
+        return self._pulled.get(str(assignment_id), 0)
+
+    def set_pulled_until(self, assignment_id, time_modified):
+        self._pulled[str(assignment_id)] = max(time_modified, self.pulled_until(assignment_id))
+
+    def write(self):
+        _dump_json(self._path, {'files': self._entries, 'pulled': self._pulled}, self._compact_output)
+
+
+class GradeJournal:
+    """
+    What grade uploaded, one json line per change: every grade is recorded as pending when the upload starts,
+    as sent before its request goes out and as confirmed once moodle answered it.
+    Lines are appended and flushed as they happen, so an interrupted upload leaves an exact record,
+    and grade --resume uploads only what was not confirmed.
+    The last confirmed grade and feedback of every user are kept across uploads, moodle does not tell the feedback.
+    """
+    pending = 'pending'
+    sent = 'sent'
+    confirmed = 'confirmed'
+
+    def __init__(self, path):
+        self._path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'rb') as file:
+                for line in file:
+                    try:
+                        record = serialization.loads(line)
+                    except serialization.DecodeError:
+                        break  # cut short by a crash, every line before it holds.
+                    self._apply(record)
+        except FileNotFoundError:
+            pass
+
+    def _apply(self, record):
+        entry = self._entries.setdefault(record['key'], {})
+        entry.update(record)
+        if record['state'] == self.confirmed:
+            entry['confirmed'] = {'grade': entry['grade'], 'feedback': entry['feedback'], 'time': record['time']}
+
+    @staticmethod
+    def key(assignment_id, user_id):
+        return f'{int(assignment_id):d}/{int(user_id):d}'
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def unfinished(self):
+        """:returns the entries, that were not confirmed, in the order they were recorded"""
+        return [e for e in self._entries.values() if e['state'] != self.confirmed]
+
+    def last_confirmed(self, assignment_id, user_id):
+        """:returns grade, feedback and time of the last confirmed upload for the user, or None"""
+        entry = self._entries.get(self.key(assignment_id, user_id))
+        return None if entry is None else entry.get('confirmed')
+
+    def is_confirmed(self, entry):
+        """if the same grade and feedback was confirmed for the user already"""
+        confirmed = self.last_confirmed(entry['assignment_id'], entry['user_id'])
+        return confirmed is not None and confirmed['grade'] == entry['grade'] and \
+            confirmed['feedback'] == entry['feedback']
+
+    def start(self, entries):
+        """a new upload: drops what the last one did not finish, keeps only the last confirmed values"""
+        kept = []
+        for entry in self._entries.values():
+            if 'confirmed' in entry:
+                kept.append(dict(entry, state=self.confirmed, **entry['confirmed']))
+                del kept[-1]['confirmed']
+        # the compacted journal replaces the old one only once it is on disk, a crash keeps either of them.
+        compacted = Path(self._path).with_name(Path(self._path).name + '.tmp')
+        with self._lock:
+            with open(compacted, 'wb') as file:
+                for record in kept:
+                    file.write(serialization.dumpb(record, compact_output=True) + b'\n')
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(compacted, self._path)
+            self._entries = {}
+            for record in kept:
+                self._apply(record)
+        self.add(entries)
+
+    def add(self, entries):
+        """records entries with assignment_id, user_id, grade, feedback and team_submission as pending"""
+        records = []
+        for entry in entries:
+            record = dict(entry, key=self.key(entry['assignment_id'], entry['user_id']), state=self.pending)
+            entry['key'] = record['key']
+            records.append(record)
+        self._append(records)
+
+    def mark(self, keys, state):
+        now = int(time.time())
+        self._append([{'key': key, 'state': state, 'time': now} for key in keys])
+
+    def _append(self, records):
+        if len(records) == 0:
+            return
+        with self._lock:
+            with open(self._path, 'ab') as file:
+                for record in records:
+                    self._apply(record)
+                    file.write(serialization.dumpb(record, compact_output=True) + b'\n')
+                file.flush()
+                os.fsync(file.fileno())
+
 
 class Config(models.JsonDictWrapper):
     error_msg = """
@@ -297,8 +549,7 @@ class MdtConfig:
         locations = self.global_config_locations()
         for file_name in locations:
             try:
-                with open(file_name) as file:
-                    return Config(json.load(file))
+                return Config(serialization.read_file(file_name))
             except FileNotFoundError:
                 pass
         if not self.prefer_local or init:
@@ -1,5 +1,4 @@
 import glob
-import json
 import os
 import re
 
@@ -7,8 +6,10 @@ from pathlib import Path
 
 from frontend.models import Course, GlobalConfig
 from moodle.fieldnames import JsonFieldNames as Jn
-from persistence.models import AssignmentFolder, SubmissionFolder, GradeFolder
-from util import zipwrangler
+from persistence.exceptions import NotInWorkTree
+from persistence.models import AssignmentFolder, SubmissionFolder, GradeFolder, FileMetaFolder, DownloadIndex, \
+    GradeJournal
+from util import serialization, zipwrangler
 
 
 class WorkTree:
@@ -27,8 +28,18 @@ class WorkTree:
     COURSES = 'courses'
     SYNC = 'sync'
     MOODLE = 'moodle'
+    DOWNLOADS = 'downloads'
+    GRADE_JOURNAL = 'grade_journal'
 
-    def __init__(self, init=False, force=False, skip_init=False):
+    # set by mdt serve: data keeps the json it builds the courses from, per root, until anything in .mdt changed.
+    cache_data = False
+    _data_cache = {}
+
+    def __init__(self, init=False, force=False, skip_init=False, compact_storage=None):
+        """
+        :param compact_storage: write the synced data without indentation and sorting,
+            default: the 'compact_storage' config value
+        """
         if skip_init:
             return
 
@@ -45,12 +56,18 @@ class WorkTree:
         self.sync_data = self.data_root / self.SYNC
         self.moodle_data = self.data_root / self.MOODLE
         self.course_data = self.data_root / self.COURSES
+        self.download_data = self.data_root / self.DOWNLOADS
+        self.grade_journal_data = self.data_root / self.GRADE_JOURNAL
+        if compact_storage is None:
+            compact_storage = self.get_global_config_values().compact_storage
+        self.compact_storage = compact_storage
 
         self._course_data = self._load_json_file(self.course_data)
         self._user_data = self._load_json_file(self.user_data)
-        self._assignment_data = AssignmentFolder(self.data_root, init)
-        self._submission_data = SubmissionFolder(self.data_root, init)
-        self._grade_data = GradeFolder(self.data_root, init)
+        self._assignment_data = AssignmentFolder(self.data_root, init, compact_storage)
+        self._submission_data = SubmissionFolder(self.data_root, init, compact_storage)
+        self._grade_data = GradeFolder(self.data_root, init, compact_storage)
+        self._file_meta_data = FileMetaFolder(self.data_root, init, compact_storage)
 
     @classmethod
     def _initialize(cls, force):
@@ -89,7 +106,7 @@ class WorkTree:
             local_config_file = WorkTree.get_local_config_file()
             if local_config_file:
                 global_cfg.add_overrides(WorkTree._load_json_file(local_config_file))
-        except json.JSONDecodeError:
+        except serialization.DecodeError:
             pass  # probably old ini-style config, ignore it
 
         return global_cfg
@@ -99,13 +116,12 @@ class WorkTree:
         file_names = WorkTree.get_config_file_list()
         global_config = WorkTree.get_global_config_values()
         for name in file_names:
-            with open(name) as file:
-                try:
-                    values = json.load(file)
-                    global_config.add_overrides(values)
-                except json.decoder.JSONDecodeError:
-                    # probably old-style ini config
-                    pass
+            try:
+                values = serialization.read_file(name)
+                global_config.add_overrides(values)
+            except serialization.DecodeError:
+                # probably old-style ini config
+                pass
         return global_config
 
     @classmethod
@@ -168,11 +184,43 @@ class WorkTree:
 
     @property
     def data(self):
+        """the courses with their users, assignments, submissions and grades, built anew, commands change them"""
+        if not self.cache_data:
+            return self._build_data(self._data_json())
+        signature = self._data_signature()
+        cached = self._data_cache.get(self.root)
+        if cached is None or cached[0] != signature:
+            cached = self._data_cache[self.root] = (signature, self._data_json())
+        return self._build_data(cached[1])
+
+    def _data_signature(self):
+        """modification times and sizes of all files in .mdt, changes whenever sync or pull wrote something"""
+        signature = []
+        for entry in os.scandir(self.data_root):
+            if entry.is_dir():
+                signature += [(e.path, e.stat().st_mtime_ns, e.stat().st_size) for e in os.scandir(entry.path)]
+            elif entry.is_file():
+                signature.append((entry.path, entry.stat().st_mtime_ns, entry.stat().st_size))
+        return sorted(signature)
+
+    def _data_json(self):
+        """the decoded files data is built from, the models only wrap them"""
+        assignments = dict(self.assignments.items())
+        return {
+            'courses': list(self.courses.values()),
+            'users': self.users,
+            'assignments': list(assignments.values()),
+            'submissions': {a_id: self.submissions.get(a_id, None) for a_id in assignments},
+            'grades': {a_id: self.grades.get(a_id, None) for a_id in assignments},
+        }
+
+    @staticmethod
+    def _build_data(json_data):
         cs = []
 
-        for course_data in self.courses.values():
+        for course_data in json_data['courses']:
             course = Course(course_data)
-            users = self.users
+            users = json_data['users']
             if users is None or len(users) == 0:
                 no_users_msg = """
                 No users in courses found.
@@ -185,15 +233,15 @@ class WorkTree:
                     course.users = users[str(course.id)]
 
             assignment_list = []
-            for assignment_data in self.assignments.values():
+            for assignment_data in json_data['assignments']:
                 if assignment_data[Jn.course] == course.id:
                     assignment_list.append(assignment_data)
             # course.assignments = [a for a in self.assignments.values() if a[Jn.course] == course.id]
             course.assignments = assignment_list
 
             for assignment in course.assignments.values():
-                assignment.submissions = self.submissions.get(assignment.id, None)
-                assignment.grades = self.grades.get(assignment.id, None)
+                assignment.submissions = json_data['submissions'].get(assignment.id, None)
+                assignment.grades = json_data['grades'].get(assignment.id, None)
 
             cs.append(course)
         return cs
@@ -215,28 +263,41 @@ class WorkTree:
 
     @courses.setter
     def courses(self, value):
-        self._write_data(self.course_data, value)
+        self._write_data(self.course_data, value, self.compact_storage)
         self._course_data = value
 
     @property
     def grades(self):
         return self._grade_data
 
+    @property
+    def file_meta(self):
+        return self._file_meta_data
+
+    @property
+    def downloads(self):
+        """read on every access, the index is only needed by pull."""
+        return DownloadIndex(self.download_data, self.compact_storage)
+
+    @property
+    def grade_journal(self):
+        """read on every access, like downloads."""
+        return GradeJournal(self.grade_journal_data)
+
     @property
     def users(self):
         return self._user_data
 
     @users.setter
     def users(self, value):
-        self._write_data(self.user_data, value)
+        self._write_data(self.user_data, value, self.compact_storage)
         self._user_data = value
 
     @staticmethod
     def _load_json_file(filename):
         try:
-            with open(filename) as file:
-                return json.load(file)
-        except json.decoder.JSONDecodeError as e:
+            return serialization.read_file(filename)
+        except serialization.DecodeError as e:
             print(e)
             pass
 
@@ -246,9 +307,8 @@ class WorkTree:
             file.write(data)
 
     @staticmethod
-    def _write_data(path, data):
-        with open(path, 'w') as file:
-            json.dump(data, file, indent=2, ensure_ascii=False, sort_keys=True)
+    def _write_data(path, data, compact_output=False):
+        serialization.write_file(path, data, compact_output)
 
     def _merge_json_data_in_folder(self, path):
         files = glob.glob(path + '*')
@@ -295,16 +355,37 @@ class WorkTree:
         for folder in folders:
             folder.mkdir(exist_ok=True, parents=True)
 
-    def write_submission_file(self, file, content):
-        with open(file.path, 'wb') as fd:
-            fd.write(content)
+    @staticmethod
+    def partial_download_path(file):
+        return file.path.with_name(file.path.name + '.part')
+
+    def store_submission_file(self, file):
+        """
+        moves a completed download from its partial_download_path into place and unpacks zip files,
+        over the folder of an earlier download, which is only pulled again if it changed.
+        """
+        os.replace(str(self.partial_download_path(file)), str(file.path))
+        if file.path.suffix == '.zip':
+            zipwrangler.clean_unzip_with_temp_dir(file.path, target=file.path.parent, overwrite=True,
+                                                  remove_zip=True)
+
+    @staticmethod
+    def submission_file_exists(file):
+        """zip files don't exist after unpacking, but the folder they were unpacked to does"""
         if file.path.suffix == '.zip':
-            zipwrangler.clean_unzip_with_temp_dir(file.path, target=file.path.parent, remove_zip=True)
+            return (file.path.parent / file.path.stem).is_dir()
+        return file.path.is_file()
 
-    def prepare_download(self, assignments):
+    def prepare_download(self, assignments, include=None, create_folders=True):
+        """
+        :param include: optional predicate, only files of submissions it accepts are prepared
+        :param create_folders: False leaves that to the caller, e.g. for files it plans to download
+        """
         files = []
         for a in assignments:
             for s in a.submissions.values():
+                if include is not None and not include(s):
+                    continue
                 a_folder = self.root / self.formatted_assignment_folder(a)
                 s_files = s.files
                 if len(s_files) > 1:
@@ -318,13 +399,6 @@ class WorkTree:
                     path += file.path[1:].replace('/', '_')
                     file.path = a_folder / file.name
                     files.append(file)
-        self.create_folders(files)
+        if create_folders:
+            self.create_folders(files)
         return files
-
-
-class NotInWorkTree(Exception):
-    def __init__(self):
-        self.message = 'You are not in an initialized work tree. Go get one.'
-
-    def __str__(self):
-        return self.message
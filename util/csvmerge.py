@@ -0,0 +1,73 @@
+import csv
+
+group_key = 'Gruppe'
+single_key = 'Vollständiger Name'
+grade_key = 'Bewertung'
+feedback_key = 'Feedback als Kommentar'
+
+
+def index_grading_file(grading, key):
+    """
+    Reads the grading csv into a dict, indexed by key.
+
+    :param grading: opened grading file
+    :param key: the column to join on
+    :return: the index and a list of keys occurring more than once, the last row of a key wins.
+    """
+    index = {}
+    duplicates = []
+    for row in csv.DictReader(grading):
+        if row[key] in index:
+            duplicates.append(row[key])
+        index[row[key]] = row
+    return index, duplicates
+
+
+def merge(grading, moodle, result, single=False, feedback=True):
+    """
+    Merges the grades of an offline grading worksheet into a moodle export.
+    Only the grading file is held in memory, the moodle export is streamed row by row,
+    every matched row is written to result right away.
+
+    :param grading: opened grading file, containing the grades
+    :param moodle: opened moodle export, the worksheet moodle gave you
+    :param result: opened file to write the merged rows to
+    :param single: join on 'Vollständiger Name' instead of 'Gruppe'
+    :param feedback: also copy the 'Feedback als Kommentar' column
+    :return: (count of written rows, unmatched grading keys, unmatched moodle keys, duplicate grading keys)
+    """
+    key = single_key if single else group_key
+    index, duplicates = index_grading_file(grading, key)
+
+    reader_moodle = csv.DictReader(moodle)
+    writer = csv.DictWriter(result,
+                            reader_moodle.fieldnames,
+                            quotechar='"',
+                            quoting=csv.QUOTE_NONNUMERIC)
+    writer.writeheader()
+
+    written = 0
+    matched = set()
+    unmatched_moodle = {}  # dict keeps order, a group has multiple rows
+    for row in reader_moodle:
+        try:
+            line = index[row[key]]
+        except KeyError:
+            unmatched_moodle[row[key]] = None
+            continue
+        row[grade_key] = line[grade_key]
+        if feedback:
+            row[feedback_key] = line[feedback_key]
+        writer.writerow(row)
+        matched.add(row[key])
+        written += 1
+
+    unmatched_grading = [k for k in index if k not in matched]
+    return written, unmatched_grading, list(unmatched_moodle), duplicates
+
+
+def merge_files(grading_file_name, moodle_file_name, result_file_name, single=False, feedback=True):
+    with open(grading_file_name, newline='') as grading, \
+            open(moodle_file_name, newline='') as moodle, \
+            open(result_file_name, 'w', newline='') as result:
+        return merge(grading, moodle, result, single=single, feedback=feedback)
@@ -0,0 +1,118 @@
+import collections
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+@contextlib.contextmanager
+def profiled(file_name, top=20, out=sys.stderr):
+    """
+    Runs the block under cProfile, dumps the pstats to file_name and prints the top entries by cumulative time.
+    cProfile only sees the thread it was started in, see SamplingProfiler for the worker threads.
+
+    :param file_name: where to write the pstats, readable by pstats.Stats or snakeviz
+    :param top: number of functions in the summary
+    :param out: where to print the summary
+    """
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        profile.dump_stats(file_name)
+        summary = io.StringIO()
+        stats = pstats.Stats(profile, stream=summary)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        print(f'profile written to {file_name}, top {top:d} by cumulative time:', file=out)
+        print(summary.getvalue().strip('\n'), file=out)
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno:d})'
+
+
+class SamplingProfiler:
+    """
+    Wall clock sampling profiler: looks at the stacks of all threads every interval seconds.
+    Unlike cProfile, it sees download and upload workers and time spent waiting on the network.
+
+    The samples are written as folded stacks, one 'thread;outer;…;inner count' per line,
+    the input format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = collections.Counter()  # folded stack: count
+        self.sample_count = 0
+        self.elapsed = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.samples[';'.join(reversed(stack))] += 1
+        self.sample_count += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self.elapsed = -time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='sampling profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed += time.perf_counter()
+
+    def write_folded(self, file_name):
+        with open(file_name, 'w') as file:
+            for stack, count in self.samples.most_common():
+                file.write(f'{stack} {count:d}\n')
+
+    def summary(self, top=20):
+        """functions by share of samples they were on the stack in, per thread"""
+        inclusive = collections.Counter()
+        for stack, count in self.samples.items():
+            thread, *frames = stack.split(';')
+            for name in set(frames):
+                inclusive[(thread, name)] += count
+        seconds_per_sample = self.elapsed / max(self.sample_count, 1)
+        lines = []
+        for (thread, name), count in inclusive.most_common(top):
+            lines.append(f'{count * seconds_per_sample:8.3f}s {thread:>22} {name}')
+        return lines
+
+
+@contextlib.contextmanager
+def sampled(file_name, interval=0.005, top=20, out=sys.stderr):
+    """runs the block with a SamplingProfiler, writes folded stacks to file_name and prints a summary"""
+    profiler = SamplingProfiler(interval).start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        profiler.write_folded(file_name)
+        print(f'{profiler.sample_count:d} samples in {profiler.elapsed:.2f}s written to {file_name}, '
+              f'top {top:d} by wall time on stack:', file=out)
+        for line in profiler.summary(top):
+            print(line, file=out)
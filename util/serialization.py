@@ -0,0 +1,80 @@
+"""
+All json en- and decoding of mdt goes through here.
+
+The fastest installed backend is picked at import time: orjson, ujson or the standard library.
+Set MDT_JSON_BACKEND to one of these names to force a backend, e.g. for comparing them.
+"""
+import json
+import os
+
+backends = ['orjson', 'ujson', 'json']
+
+DecodeError = json.JSONDecodeError
+
+
+def _select_backend(preferred=None):
+    names = backends if preferred is None else [preferred]
+    for name in names:
+        if name == 'json':
+            return name, json
+        try:
+            return name, __import__(name)
+        except ImportError:
+            continue
+    return 'json', json
+
+
+backend, _module = _select_backend(os.environ.get('MDT_JSON_BACKEND'))
+
+if backend == 'ujson':
+    DecodeError = ValueError  # ujson raises plain ValueErrors.
+
+
+def loads(data, strict=True):
+    """
+    :param data: str or bytes
+    :param strict: False allows control characters like raw new lines in strings, only the stdlib supports that
+    """
+    if not strict:
+        return json.loads(data, strict=False)
+    return _module.loads(data)
+
+
+def dumpb(data, compact_output=False):
+    """
+    :param compact_output: no indentation and unsorted keys
+    :returns utf-8 encoded json
+    """
+    if backend == 'orjson':
+        option = _module.OPT_NON_STR_KEYS
+        if not compact_output:
+            option |= _module.OPT_INDENT_2 | _module.OPT_SORT_KEYS
+        return _module.dumps(data, option=option)
+    return dumps(data, compact_output).encode()
+
+
+def dumps(data, compact_output=False):
+    if backend == 'orjson':
+        return dumpb(data, compact_output).decode()
+    if backend == 'ujson':
+        if compact_output:
+            return _module.dumps(data, ensure_ascii=False)
+        return _module.dumps(data, ensure_ascii=False, indent=2, sort_keys=True)
+    if compact_output:
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    return json.dumps(data, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+def load(file, strict=True):
+    """decodes an open text or binary file"""
+    return loads(file.read(), strict=strict)
+
+
+def read_file(path, strict=True):
+    with open(path, 'rb') as file:
+        return loads(file.read(), strict=strict)
+
+
+def write_file(path, data, compact_output=False):
+    with open(path, 'wb') as file:
+        file.write(dumpb(data, compact_output))
@@ -0,0 +1,209 @@
+"""
+Optional background server of a work tree: it keeps mdt imported, the moodle session with its open
+connections and the parsed work tree in memory, and runs status, sync and pull for the mdt command line,
+which talks to it over the unix socket .mdt/mdt.sock. Without a running server, mdt runs commands itself.
+
+Only imports the standard library at module level, the client side has to be cheap.
+"""
+import contextlib
+import io
+import json
+import os
+import socket
+import sys
+import threading
+import traceback
+from pathlib import Path
+
+socket_name = 'mdt.sock'
+data_folder = '.mdt'  # WorkTree.DATA_FOLDER, without importing it.
+
+# non interactive commands, the others could ask for input, which a server can't answer.
+served_commands = frozenset(['status', 'sync', 'pull'])
+
+
+def find_socket(start=None):
+    """:returns the socket path of the work tree containing start, default: cwd, or None"""
+    cwd = Path.cwd() if start is None else Path(start)
+    for folder in [cwd] + list(cwd.parents):
+        if (folder / data_folder).is_dir():
+            path = folder / data_folder / socket_name
+            return path if path.exists() else None
+    return None
+
+
+def _connect(path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(str(path))
+    except OSError:
+        client.close()
+        raise
+    return client
+
+
+def _send(connection, **message):
+    connection.sendall(json.dumps(message).encode() + b'\n')
+
+
+def _messages(connection):
+    with connection.makefile('rb') as lines:
+        for line in lines:
+            yield json.loads(line)
+
+
+def run_remote(argv, cwd=None):
+    """
+    runs the command line argv on the server of the work tree, forwarding its output.
+
+    :returns the exit code, or None if no server is running, then the caller runs the command itself
+    """
+    path = find_socket(cwd)
+    if path is None:
+        return None
+    try:
+        connection = _connect(path)
+    except OSError:  # a stale socket of a server, that did not shut down cleanly.
+        return None
+    with connection:
+        _send(connection, argv=list(argv), cwd=str(Path.cwd() if cwd is None else cwd))
+        for message in _messages(connection):
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            elif 'err' in message:
+                sys.stderr.write(message['err'])
+                sys.stderr.flush()
+            elif 'exit' in message:
+                return message['exit']
+    return 1  # the server went away mid command.
+
+
+def stop_remote(cwd=None):
+    """:returns True if a server was running and was asked to stop"""
+    path = find_socket(cwd)
+    if path is None:
+        return False
+    try:
+        with _connect(path) as connection:
+            _send(connection, stop=True)
+            for _ in _messages(connection):
+                pass
+    except OSError:
+        path.unlink()
+        return False
+    return True
+
+
+class _Forward(io.TextIOBase):
+    """a text stream sending every write to the client, tagged as out or err, download threads print too"""
+
+    def __init__(self, connection, tag, lock):
+        self.connection = connection
+        self.tag = tag
+        self.lock = lock
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if len(text) > 0:
+            with self.lock:
+                _send(self.connection, **{self.tag: text})
+        return len(text)
+
+
+def _run_command(argv):
+    from frontend import commands
+    from moodle.exceptions import FunctionNotAvailable
+    from persistence.exceptions import NotInWorkTree
+
+    parser = commands.make_config_parser()
+    try:
+        args, unknown = parser.parse_known_args(argv)
+        kwargs = vars(args)
+        func = kwargs.pop('func')
+        func(**kwargs)
+        return 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except (NotInWorkTree, FunctionNotAvailable) as e:
+        print(e)
+        return 1
+    except Exception:
+        print('onoz…')
+        traceback.print_exc()
+        return 1
+
+
+def _handle(connection):
+    request = next(_messages(connection), None)
+    if request is None:
+        return True
+    if request.get('stop', False):
+        return False
+    argv = request['argv']
+    if len(argv) == 0 or argv[0] not in served_commands:
+        _send(connection, err=f'not served: {" ".join(argv)}\n')
+        _send(connection, exit=1)
+        return True
+
+    old_cwd = os.getcwd()
+    lock = threading.Lock()
+    out, err = _Forward(connection, 'out', lock), _Forward(connection, 'err', lock)
+    try:
+        os.chdir(request['cwd'])
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            sys.stdin = io.StringIO()  # input() fails, instead of waiting for a terminal that isn't there.
+            code = _run_command(argv)
+        _send(connection, exit=code)
+    finally:
+        sys.stdin = sys.__stdin__
+        os.chdir(old_cwd)
+    return True
+
+
+def serve(root, idle_timeout=900):
+    """
+    Serves the work tree at root until it was idle for idle_timeout seconds, or is stopped.
+    Requests are run one after another, status waits for a running pull.
+    """
+    from persistence.worktree import WorkTree
+
+    path = Path(root) / data_folder / socket_name
+    if path.exists():
+        try:
+            _connect(path).close()
+            print(f'a server is running already: {path}')
+            return
+        except OSError:
+            path.unlink()
+
+    WorkTree.cache_data = True
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(str(path))
+        os.chmod(str(path), 0o600)
+        listener.listen()
+        listener.settimeout(idle_timeout)
+        running = True
+        while running:
+            try:
+                connection, _ = listener.accept()
+            except socket.timeout:
+                break
+            with connection:
+                connection.settimeout(None)
+                try:
+                    running = _handle(connection)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client went away, e.g. on ctrl-c.
+                except Exception as e:
+                    # one failed request, like for a cwd that is gone, is no reason to stop serving the others.
+                    with contextlib.suppress(OSError):
+                        _send(connection, err=f'mdt serve: {type(e).__name__}: {e}\n')
+                        _send(connection, exit=1)
+    finally:
+        listener.close()
+        with contextlib.suppress(FileNotFoundError):
+            path.unlink()
@@ -0,0 +1,102 @@
+import re
+import threading
+import time
+
+_size_pattern = re.compile(r'^\s*(?P<number>[0-9]+(\.[0-9]*)?)\s*(?P<unit>[kKmMgG]?)i?[bB]?\s*$')
+_units = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+# download orders of pull.
+smallest_first = 'smallest'
+assignments_first = 'assignments'
+
+
+def parse_size(text):
+    """'500', '200k', '1.5M' or '2GiB' to bytes, units are powers of 1024"""
+    match = _size_pattern.match(str(text))
+    if match is None:
+        raise ValueError(f'not a size: {text}')
+    return int(float(match.group('number')) * _units[match.group('unit').lower()])
+
+
+def format_size(size):
+    for unit in ['B', 'KiB', 'MiB']:
+        if size < 1024:
+            return f'{size:.1f}{unit}' if unit != 'B' else f'{size:d}B'
+        size /= 1024
+    return f'{size:.1f}GiB'
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return f'{hours:d}:{minutes:02d}:{seconds:02d}'
+    return f'{minutes:d}:{seconds:02d}'
+
+
+class TokenBucket:
+    """
+    Caps the bytes per second of all threads taking from it together.
+    Taking more than is available puts the bucket in debt, the taker sleeps until it is paid off,
+    so large chunks are allowed, but the average rate holds.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: bytes per second
+        :param burst: bytes that may be taken at once after idling, default: one second worth
+        """
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TransferMeter:
+    """bytes received by all download threads, for throughput and the estimated time left"""
+
+    def __init__(self, total_bytes=0):
+        self.total_bytes = total_bytes
+        self.received = 0
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, amount):
+        with self._lock:
+            self.received += amount
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self._start
+
+    @property
+    def rate(self):
+        """bytes per second since the meter was created"""
+        elapsed = self.elapsed
+        return self.received / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """seconds left at the current rate, None if that can't be told yet"""
+        rate = self.rate
+        if rate <= 0 or self.total_bytes <= 0:
+            return None
+        return max(self.total_bytes - self.received, 0) / rate
+
+    def __str__(self):
+        text = f'{format_size(self.received)} {format_size(int(self.rate))}/s'
+        eta = self.eta
+        if eta is not None:
+            text += f' ETA {format_duration(eta)}'
+        return text
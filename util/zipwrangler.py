@@ -17,24 +17,25 @@ def get_cleaned_contents(zipfile, ignore_list=ignore, verbose=False):
 
 
 def clean_unzip_with_temp_dir(zipfilename: Path, target=None, ignore_list=ignore, overwrite=False, remove_zip=False):
-    zipfile = ZipFile(str(zipfilename))
+    """
+    :param overwrite: replace an existing folder, it is swapped for the new one after extracting completely
+    :returns if the zip was extracted
+    """
     if target is None:
         target = Path.cwd() / zipfilename.stem
     else:
         target = target / zipfilename.stem
-    try:
-        target.mkdir(exist_ok=overwrite)
-    except FileExistsError:
+    if target.exists() and not overwrite:
         print(f'file exists, not extracting {zipfilename.name} to {target}')
-        return
+        return False
 
-    contents = get_cleaned_contents(zipfile, ignore_list)
-    with TemporaryDirectory(dir=Path.cwd().absolute()) as tempdir:
+    with ZipFile(str(zipfilename)) as zipfile, TemporaryDirectory(dir=str(target.parent.absolute())) as tempdir:
         temp = Path(tempdir)
-        for file in contents:
-            zipfile.extract(file, path=tempdir)
+        extracted = temp / 'extracted'
+        for file in get_cleaned_contents(zipfile, ignore_list):
+            zipfile.extract(file, path=str(extracted))
 
-        contents = list(temp.iterdir())
+        contents = list(extracted.iterdir()) if extracted.is_dir() else []
         while len(contents) == 1:
             content = contents.pop()
             if content.is_dir():
@@ -43,11 +44,17 @@ def clean_unzip_with_temp_dir(zipfilename: Path, target=None, ignore_list=ignore
                 contents = [content]
                 break
 
+        staged = temp / 'staged'
+        staged.mkdir()
         for i in contents:
-            shutil.move(str(i), str(target))
+            shutil.move(str(i), str(staged))
+        if target.is_dir():
+            shutil.rmtree(str(target))
+        staged.rename(target)
 
     if remove_zip:
         zipfilename.unlink()
+    return True
 
 
 def main():